@@ -35,14 +35,21 @@ def fit_background(spot_colors: np.ndarray, weight_shift: float = 0) -> Tuple[np
     weight_shift = np.clip(weight_shift, 1e-20, np.inf)  # ensure weight_shift > 1e-20 to avoid blow up to infinity.
 
     n_rounds, n_channels = spot_colors[0].shape
-    background_vectors = np.repeat(np.expand_dims(np.eye(n_channels), axis=1), n_rounds, axis=1)
-    # give background_vectors an L2 norm of 1 so can compare coefficients with other genes.
-    background_vectors = background_vectors / np.linalg.norm(background_vectors, axis=(1, 2), keepdims=True)
-
-    weight_factor = 1 / (np.abs(spot_colors) + weight_shift)
+    # give background_vectors an L2 norm of 1 so can compare coefficients with other genes. Each has n_rounds non-zero
+    # values which are all the same, so this is just 1 / sqrt(n_rounds) and no norm needs computing.
+    background_value = 1 / np.sqrt(n_rounds)
+    background_vectors = np.zeros((n_channels, n_rounds, n_channels))
+    background_vectors[np.arange(n_channels), :, np.arange(n_channels)] = background_value
+
+    # Every non-zero value of every background vector is the same, so only the scalar is needed. The weighting is
+    # computed in place, rather than building n_spots x n_rounds x n_channels temporaries for each broadcast.
+    weight_factor = np.abs(spot_colors)
+    weight_factor += weight_shift
+    np.reciprocal(weight_factor, out=weight_factor)
     spot_weight = spot_colors * weight_factor
-    background_weight = np.ones((1, n_rounds, n_channels)) * background_vectors[0, 0, 0] * weight_factor
-    coef = np.sum(spot_weight * background_weight, axis=1) / np.sum(background_weight ** 2, axis=1)
-    residual = spot_colors - np.expand_dims(coef, 1) * np.ones((1, n_rounds, n_channels)) * background_vectors[0, 0, 0]
+    background_weight = np.multiply(weight_factor, background_value, out=weight_factor)
+    coef = np.einsum('src,src->sc', spot_weight, background_weight) / \
+        np.einsum('src,src->sc', background_weight, background_weight)
+    residual = spot_colors - coef[:, np.newaxis] * background_value
 
     return residual, coef, background_vectors
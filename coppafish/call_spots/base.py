@@ -72,20 +72,20 @@ def get_bled_codes(gene_codes: np.ndarray, bleed_matrix: np.ndarray, gene_effici
     n_rounds, n_channels, n_dyes = bleed_matrix.shape
     if not utils.errors.check_shape(gene_codes, [n_genes, n_rounds]):
         raise utils.errors.ShapeError('gene_codes', gene_codes.shape, (n_genes, n_rounds))
-    if gene_codes.max() >= n_dyes:
-        ind_1, ind_2 = np.where(gene_codes == gene_codes.max())
-        raise ValueError(f"gene_code for gene {ind_1[0]}, round {ind_2[0]} has a dye with index {gene_codes.max()}"
+    # Find the range of dye indices once, rather than reducing gene_codes again for each check and error message
+    gene_codes_min, gene_codes_max = gene_codes.min(), gene_codes.max()
+    if gene_codes_max >= n_dyes:
+        ind_1, ind_2 = np.where(gene_codes == gene_codes_max)
+        raise ValueError(f"gene_code for gene {ind_1[0]}, round {ind_2[0]} has a dye with index {gene_codes_max}"
                          f" but there are only {n_dyes} dyes.")
-    if gene_codes.min() < 0:
-        ind_1, ind_2 = np.where(gene_codes == gene_codes.min())
+    if gene_codes_min < 0:
+        ind_1, ind_2 = np.where(gene_codes == gene_codes_min)
         raise ValueError(f"gene_code for gene {ind_1[0]}, round {ind_2[0]} has a dye with a negative index:"
-                         f" {gene_codes.min()}")
+                         f" {gene_codes_min}")
 
-    bled_codes = np.zeros((n_genes, n_rounds, n_channels))
-    for g in range(n_genes):
-        for r in range(n_rounds):
-            for c in range(n_channels):
-                bled_codes[g, r, c] = gene_efficiency[g, r] * bleed_matrix[r, c, gene_codes[g, r]]
+    # bleed_matrix[r, :, gene_codes[g, r]] for every gene and round is gathered with one fancy index, giving an
+    # n_genes x n_rounds x n_channels array, rather than looping over genes, rounds and channels in python
+    bled_codes = gene_efficiency[:, :, np.newaxis] * bleed_matrix[np.arange(n_rounds), :, gene_codes]
 
     # Give all bled codes an L2 norm of 1
     norm_factor = np.linalg.norm(bled_codes, axis=(1,2))
@@ -124,30 +124,26 @@ def compute_gene_efficiency(spot_colours: np.ndarray, bled_codes: np.ndarray, ge
     n_genes = gene_codes.shape[0]
     gene_efficiency = np.ones([n_genes, n_rounds])
     dye_efficiency = np.ones([n_genes, n_rounds, 0]).tolist()
-    use_ge = np.zeros(n_spots, dtype=bool)
-
-    # Compute gene efficiency for each gene and round.
-    for g in range(n_genes):
-        gene_g_mask = (gene_no == g) * (gene_score > score_threshold) * (intensity > intensity_threshold)
-        # Skip gene if not enough spots.
-        if np.sum(gene_g_mask) < spot_number_threshold:
-            continue
-        use_ge += gene_g_mask
-        gene_g_spot_colours = spot_colours[gene_g_mask]
-        dye_efficiency_g = np.ones([gene_g_spot_colours.shape[0], n_rounds])
-        for r in range(n_rounds):
-            # Compute gene efficiency for each round. This is just the best scaling factor to match the mean/median
-            # spot colour to the expected spot colour.
-            expected_spot_colour = bled_codes[g, r]
-            observed_spot_colour = gene_g_spot_colours[:, r]
-            for s in range(observed_spot_colour.shape[0]):
-                a = observed_spot_colour[s]
-                b = expected_spot_colour
-                # Compute scaling factor.
-                dye_efficiency_g[s, r] = np.dot(a, b) / np.dot(b, b)
-            # Compute gene efficiency as the median dye efficiency across spots.
-            gene_efficiency[g, r] = np.median(dye_efficiency_g[:, r])
-            dye_efficiency[g][r] = dye_efficiency_g[:, r]
+
+    # Only compute gene efficiency for genes with enough spots passing the score and intensity thresholds. Other genes
+    # keep a gene efficiency of 1.
+    spot_mask = (gene_score > score_threshold) * (intensity > intensity_threshold)
+    gene_n_spots = np.bincount(gene_no[spot_mask], minlength=n_genes)
+    use_genes = np.where(gene_n_spots >= spot_number_threshold)[0]
+    use_ge = spot_mask * np.isin(gene_no, use_genes)
+    use_gene_no = gene_no[use_ge]
+
+    # Compute the dye efficiency of every spot used in each round, all at once. This is just the best scaling factor to
+    # match the spot colour to the expected spot colour of its gene.
+    expected_spot_colours = bled_codes[use_gene_no]
+    all_dye_efficiency = np.einsum('src,src->sr', spot_colours[use_ge], expected_spot_colours) / \
+        np.einsum('src,src->sr', expected_spot_colours, expected_spot_colours)
+
+    # Compute gene efficiency as the median dye efficiency across spots.
+    for g in use_genes:
+        dye_efficiency_g = all_dye_efficiency[use_gene_no == g]
+        gene_efficiency[g] = np.median(dye_efficiency_g, axis=0)
+        dye_efficiency[g] = [dye_efficiency_g[:, r] for r in range(n_rounds)]
 
     # Set negative values to 0.
     gene_efficiency[gene_efficiency < 0] = 0
@@ -1,7 +1,7 @@
 import numpy as np
 from .. import utils
 from typing import Tuple, List, Union
-import itertools
+import pandas
 import matplotlib.pyplot as plt
 
 
@@ -38,24 +38,22 @@ def get_dye_channel_intensity_guess(csv_file_name: str, dyes: Union[List[str], n
     if not utils.errors.check_shape(cameras, lasers.shape):
         raise utils.errors.ShapeError('cameras', cameras.shape, lasers.shape)
 
-    # load in csv info
-    csv_dyes = np.genfromtxt(csv_file_name, delimiter=',', usecols=0, dtype=str, skip_header=1)
-    csv_cameras = np.genfromtxt(csv_file_name, delimiter=',', usecols=1, dtype=int, skip_header=1)
-    csv_lasers = np.genfromtxt(csv_file_name, delimiter=',', usecols=2, dtype=int, skip_header=1)
-    csv_intensities = np.genfromtxt(csv_file_name, delimiter=',', usecols=3, dtype=float, skip_header=1)
-
-    # read in intensity from csv info for desired dyes in each channel
-    dye_channel_intensity = np.zeros((n_dyes, n_channels))
-    for d in range(n_dyes):
-        correct_dye = csv_dyes == dyes[d].upper()
-        for c in range(n_channels):
-            correct_camera = csv_cameras == cameras[c]
-            correct_laser = csv_lasers == lasers[c]
-            correct_all = np.all((correct_dye, correct_camera, correct_laser), axis=0)
-            if sum(correct_all) != 1:
-                raise ValueError(f"Expected intensity for dye {dyes[d]}, camera {cameras[c]} and laser {lasers[c]} "
-                                 f"to be found once in csv_file. Instead, it was found {sum(correct_all)} times.")
-            dye_channel_intensity[d, c] = csv_intensities[np.where(correct_all)[0][0]]
+    # load in csv info, reading the file once. Then store the intensity for each (dye, camera, laser) in a dict
+    csv_info = pandas.read_csv(csv_file_name)
+    csv_intensity, csv_count = {}, {}
+    for dye, camera, laser, intensity in zip(csv_info.iloc[:, 0].astype(str), csv_info.iloc[:, 1].astype(int),
+                                             csv_info.iloc[:, 2].astype(int), csv_info.iloc[:, 3].astype(float)):
+        csv_intensity[(dye, camera, laser)] = intensity
+        csv_count[(dye, camera, laser)] = csv_count.get((dye, camera, laser), 0) + 1
+
+    # read in intensity from csv info for desired dyes in each channel, with one dict lookup per dye and channel
+    keys = [(dyes[d].upper(), int(cameras[c]), int(lasers[c])) for d in range(n_dyes) for c in range(n_channels)]
+    for i, key in enumerate(keys):
+        if csv_count.get(key, 0) != 1:
+            d, c = np.unravel_index(i, (n_dyes, n_channels))
+            raise ValueError(f"Expected intensity for dye {dyes[d]}, camera {cameras[c]} and laser {lasers[c]} "
+                             f"to be found once in csv_file. Instead, it was found {csv_count.get(key, 0)} times.")
+    dye_channel_intensity = np.array([csv_intensity[key] for key in keys], dtype=float).reshape(n_dyes, n_channels)
 
     return dye_channel_intensity
 
@@ -71,7 +69,8 @@ def compute_bleed_matrix(bleed_matrix_norm: np.ndarray, spot_colours: np.ndarray
 
     Args:
         bleed_matrix_norm: n_channels x n_dyes bleed matrix (each column normalised)
-        spot_colours: n_spots x n_rounds x n_channels colour matrix for each isolated spot
+        spot_colours: n_spots x n_rounds x n_channels colour matrix for each isolated spot. If float32, all
+            computation is done in float32
         spot_tile: n_spots array of tile numbers for each spot
         n_tiles: int. Number of tiles in experiment
         tile_split: bool. If True, then compute bleed matrix for each tile separately. Default = False
@@ -93,67 +92,85 @@ def compute_bleed_matrix(bleed_matrix_norm: np.ndarray, spot_colours: np.ndarray
         bleed_tiles = 1
 
     n_rounds, n_channels = spot_colours.shape[1], spot_colours.shape[2]
-    # Now define bleed matrix
-    bleed_matrix = np.zeros((bleed_tiles, bleed_rounds, bleed_matrix_norm.shape[0], bleed_matrix_norm.shape[1]))
-    colour_vector = np.zeros((bleed_tiles, bleed_rounds, 0)).tolist()
-
-    # Populate colour vector with spot colours
-    for t, r in itertools.product(range(bleed_tiles), range(bleed_rounds)):
-        # Cover 4 cases: tile_split, round_split, both, neither
-        if tile_split and round_split:
-            colour_vector[t][r] = spot_colours[spot_tile == t, r, :]
-        elif tile_split and not round_split:
-            colour_vector[t][r] = spot_colours[spot_tile == t, :, :].reshape(-1, n_channels)
-        elif not tile_split and round_split:
-            colour_vector[t][r] = spot_colours[:, r, :]
-        else:
-            colour_vector[t][r] = spot_colours.reshape(-1, n_channels)
-
-    # Now compute the bleed matrices
-    for t, r in itertools.product(range(bleed_tiles), range(bleed_rounds)):
-        # Now compute the dot product of each spot with each dye. This gives an n_spots_use x n_dyes matrix.
-        all_dye_score = colour_vector[t][r] @ bleed_matrix_norm
-        # Now assign each spot a dye which is its highest score
-        spot_dye, spot_dye_score = np.argmax(all_dye_score, axis=1), np.max(all_dye_score, axis=1)
-        spot_dye_score_second = np.sort(all_dye_score, axis=1)[:, -2]
-        # Now we want to remove all spots which have a score of 0 or less than twice the second-highest score
-        keep = (spot_dye_score > 0) * (spot_dye_score > 2 * spot_dye_score_second)
-
-        # Now we loop over the dyes and fine tune the spectrum for each dye
-        for d in range(n_dyes):
-            # Get all spots which have been confidently assigned to dye d
-            d_spots = colour_vector[t][r][(spot_dye == d) * keep]
-            # Compute the first singular vector of these spots
-            d_spectrum, d_score = fine_tune_dye_spectrum(spot_colours=d_spots)
-            bleed_matrix[t, r, :, d] = d_spectrum
-
-        # Now normalise the bleed matrix
-        bleed_matrix[t, r] = bleed_matrix[t, r] / np.linalg.norm(bleed_matrix[t, r])
+    if spot_colours.dtype == np.float32:
+        # Dye scores only depend on the direction of each colour vector, so single precision is plenty. Cast the
+        # bleed matrix too, otherwise numpy would upcast the spot colours to float64 for every matmul.
+        bleed_matrix_norm = bleed_matrix_norm.astype(np.float32)
+
+    # Get the colour vectors of each tile as a bleed_tiles x n_tile_spots_max x n_rounds x n_channels array, padding
+    # tiles with fewer spots with zero colour vectors. These are never assigned a dye as they score 0 for every dye.
+    # This lets the bleed matrices of all tiles (and rounds) be computed together, with one batched eigendecomposition.
+    if tile_split:
+        tile_spots = [np.where(spot_tile == t)[0] for t in range(n_tiles)]
+        n_tile_spots_max = max(len(spots) for spots in tile_spots)
+        tile_colours = np.zeros((bleed_tiles, n_tile_spots_max, n_rounds, n_channels), dtype=spot_colours.dtype)
+        tile_spot_valid = np.zeros((bleed_tiles, n_tile_spots_max), dtype=bool)
+        for t in range(n_tiles):
+            tile_colours[t, :len(tile_spots[t])] = spot_colours[tile_spots[t]]
+            tile_spot_valid[t, :len(tile_spots[t])] = True
+    else:
+        tile_colours = spot_colours[np.newaxis]
+        tile_spot_valid = np.ones((1, spot_colours.shape[0]), dtype=bool)
+    # Now get bleed_tiles x bleed_rounds x n_spots_use x n_channels colour vectors
+    if round_split:
+        colour_vector = tile_colours.swapaxes(1, 2)
+        colour_vector_valid = tile_spot_valid
+    else:
+        colour_vector = tile_colours.reshape(bleed_tiles, 1, -1, n_channels)
+        colour_vector_valid = np.repeat(tile_spot_valid, n_rounds, axis=1)
+
+    # Now compute the dot product of each spot with each dye. This gives an n_spots_use x n_dyes matrix per tile and
+    # round.
+    all_dye_score = colour_vector @ bleed_matrix_norm
+    # Now assign each spot a dye which is its highest score
+    spot_dye = np.argmax(all_dye_score, axis=-1)
+    # Only need the top 2 scores of each spot, so partition rather than sort
+    top_2_score = np.partition(all_dye_score, -2, axis=-1)
+    spot_dye_score, spot_dye_score_second = top_2_score[..., -1], top_2_score[..., -2]
+    # Now we want to remove all spots which have a score of 0 or less than twice the second-highest score
+    keep = (spot_dye_score > 0) * (spot_dye_score > 2 * spot_dye_score_second)
+
+    # Now fine tune the spectrum for each dye, using all spots which have been confidently assigned to it
+    bleed_matrix = fine_tune_dye_spectra(spot_colours=colour_vector, spot_dye=np.where(keep, spot_dye, -1),
+                                         n_dyes=n_dyes).swapaxes(-1, -2)
+
+    # Now normalise the bleed matrix of each tile and round
+    bleed_matrix = bleed_matrix / np.linalg.norm(bleed_matrix, axis=(2, 3), keepdims=True)
+    # Return the scores of the spots in the final tile and round
+    all_dye_score = all_dye_score[-1, -1][colour_vector_valid[-1]]
 
     return bleed_matrix, all_dye_score
 
 
-def fine_tune_dye_spectrum(spot_colours: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+def fine_tune_dye_spectra(spot_colours: np.ndarray, spot_dye: np.ndarray, n_dyes: int) -> np.ndarray:
     """
-    Takes in a collection of spots' colour vectors assigned to a single dye. Then computes the first singular vector.
+    Takes in a collection of spots' colour vectors and the dye each is assigned to. Then computes the first singular
+    vector of the spots assigned to each dye. Any leading dimensions (e.g. rounds) are treated as independent
+    collections of spots, all computed together.
     Args:
-        spot_colours: n_spots x n_channels colour matrix for each isolated spot assigned to a single dye
+        spot_colours: (... x) n_spots x n_channels colour matrix for each isolated spot
+        spot_dye: (... x) n_spots array of the dye each spot is assigned to, -1 if not assigned to any dye
+        n_dyes: int. Number of dyes
 
     Returns:
-        dye_spectrum: n_channels x 1 array of the first singular vector
-        dye_score: n_spots x 1 array of the score of each spot for this dye
+        dye_spectrum: (... x) n_dyes x n_channels array of the first singular vector of each dye
 
     """
+    # One-hot matrix of the dye each spot is assigned to, all False for unassigned spots
+    spot_dye_one_hot = spot_dye[..., np.newaxis] == np.arange(n_dyes)
+
     # Compute the outer product of the colour vectors and then compute the first singular vector as the eigenvector
     # corresponding to the largest eigenvalue. This is the best vector that each spot is roughly a multiple of.
-    outer_prod = spot_colours.T @ spot_colours
-    eig_val, eig_vec = np.linalg.eig(outer_prod)
-    dye_spectrum = np.real(eig_vec[:, np.argmax(eig_val)])
-    dye_score = spot_colours @ dye_spectrum
-    dye_spectrum = dye_spectrum / np.linalg.norm(dye_spectrum)
-
-    # We expect the dye_spectrum to be positive multiples of each row. If median
-    if np.median(dye_score) < 0:
-        dye_spectrum = -dye_spectrum
-
-    return dye_spectrum, dye_score
+    # The outer products of all dyes are found with one contraction, rather than masking the spots of each dye.
+    outer_prod = np.einsum('...sd,...si,...sj->...dij', spot_dye_one_hot.astype(spot_colours.dtype), spot_colours,
+                           spot_colours, optimize=True)
+    # The outer products are symmetric so eigh is used, on all dyes at once. eigh gives real eigenvectors with
+    # eigenvalues in ascending order, so the last eigenvector is the one with the largest eigenvalue.
+    dye_spectrum = np.linalg.eigh(outer_prod)[1][..., -1]
+    dye_spectrum = dye_spectrum / np.linalg.norm(dye_spectrum, axis=-1, keepdims=True)
+
+    # We expect the dye_spectrum to be positive in each channel. If its components sum to a negative number, flip it.
+    # This only needs the spectrum itself, rather than a median of the scores of every spot assigned to the dye.
+    dye_spectrum[dye_spectrum.sum(axis=-1) < 0] *= -1
+
+    return dye_spectrum
@@ -18,23 +18,24 @@ def dot_product_score(spot_colours: np.ndarray, bled_codes: np.ndarray, weight_s
         gene_score_second: np.ndarray of second-best gene scores [n_spots]
     """
     n_spots, n_genes = spot_colours.shape[0], bled_codes.shape[0]
-    # If no weighting is given, use equal weighting
-    if weight_squared is None:
-        weight_squared = np.ones((n_spots, spot_colours.shape[1], spot_colours.shape[2]))
-    # else:
-        # First convert these matrices to vectors so that we can use the dot product.
-        # copy weight_squared along new axis
-        # weight_squared = np.repeat(weight_squared[np.newaxis, :, :], n_spots, axis=0)
-    weight_squared = weight_squared.reshape(n_spots, -1)
+    # First convert these matrices to vectors so that the scores of all spots are found with one matrix multiplication.
     spot_colours = spot_colours.reshape(n_spots, -1)
-    spot_colours = spot_colours / (np.linalg.norm(spot_colours, axis=1)[:, None] + norm_shift)
-    spot_colours = spot_colours * weight_squared
     bled_codes = bled_codes.reshape(n_genes, -1)
+    # einsum avoids the overhead of np.linalg.norm, which dominates for the short colour vectors here
+    spot_colours_norm = np.sqrt(np.einsum('ij,ij->i', spot_colours, spot_colours)) + norm_shift
+    # Spots with zero norm (and no norm_shift) are left as zero, rather than becoming nan, so they score 0 for all genes
+    spot_colours_norm[spot_colours_norm == 0] = 1
+    spot_colours = spot_colours / spot_colours_norm[:, None]
+    # If no weighting is given, use equal weighting, so there is no need to build and multiply by an array of ones.
+    # Otherwise, weight the normalised copy in place.
+    if weight_squared is not None:
+        spot_colours *= weight_squared.reshape(n_spots, -1)
 
     # Now we can obtain the dot product score for each spot and each gene
     all_score = spot_colours @ bled_codes.T
     gene_no = np.argmax(all_score, axis=1)
-    all_score = np.sort(all_score, axis=1)
+    # Only need the top 2 scores of each spot, so partition rather than sort every gene's score
+    all_score = np.partition(all_score, -2, axis=1)
     gene_score = all_score[:, -1]
     gene_score_second = all_score[:, -2]
 
@@ -89,10 +90,13 @@ def gene_prob_score(spot_colours: np.ndarray, bled_codes: np.ndarray, kappa: flo
         probability: np.ndarray of gene probabilities [n_spots, n_genes]
     """
     n_spots, n_genes = spot_colours.shape[0], bled_codes.shape[0]
-    # First, normalise spot_colours so that for each spot s and round r, norm(spot_colours[s, r, :]) = 1
-    spot_colours = spot_colours / np.linalg.norm(spot_colours, axis=2)[:, :, None]
+    # First, normalise spot_colours so that for each spot s and round r, norm(spot_colours[s, r, :]) = 1.
+    # Rounds with zero norm are left as zero, rather than becoming nan, so they give equal probability to each gene.
+    spot_colours_norm = np.sqrt(np.einsum('src,src->sr', spot_colours, spot_colours))
+    spot_colours_norm[spot_colours_norm == 0] = 1
+    spot_colours = spot_colours / spot_colours_norm[:, :, None]
     # Do the same for bled_codes
-    bled_codes = bled_codes / np.linalg.norm(bled_codes, axis=2)[:, :, None]
+    bled_codes = bled_codes / np.sqrt(np.einsum('grc,grc->gr', bled_codes, bled_codes))[:, :, None]
     # At this point, reshape spot_colours to be [n_spots, n_rounds * n_channels_use] and bled_codes to be
     # [n_genes, n_rounds * n_channels_use]
     spot_colours = spot_colours.reshape((n_spots, -1))
@@ -33,6 +33,17 @@ def test_get_bled_codes():
     bled_codes = get_bled_codes(gene_codes, bleed_matrix, gene_efficiency)
     assert bled_codes.shape == (n_genes, n_rounds, n_channels), \
         'Expected (n_genes x n_rounds x n_channels) output shape'
+    # Compare to the bled codes built one element at a time, for several genes with different dyes in each round
+    n_genes = 5
+    gene_codes = rng.randint(0, n_dyes, size=(n_genes, n_rounds))
+    gene_efficiency = rng.random((n_genes, n_rounds))
+    bled_codes = get_bled_codes(gene_codes, bleed_matrix, gene_efficiency)
+    expected = np.zeros((n_genes, n_rounds, n_channels))
+    for g in range(n_genes):
+        for r in range(n_rounds):
+            expected[g, r] = gene_efficiency[g, r] * bleed_matrix[r, :, gene_codes[g, r]]
+    expected = expected / np.linalg.norm(expected, axis=(1, 2), keepdims=True)
+    assert np.allclose(bled_codes, expected)
 
 
 def test_compute_gene_efficiency():
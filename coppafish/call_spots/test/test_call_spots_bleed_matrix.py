@@ -0,0 +1,38 @@
+from coppafish.call_spots.bleed_matrix import fine_tune_dye_spectra, compute_bleed_matrix
+
+import numpy as np
+
+
+def test_fine_tune_dye_spectra():
+    rng = np.random.RandomState(0)
+    n_spots, n_channels, n_dyes = 500, 7, 4
+    true_spectrum = rng.rand(n_dyes, n_channels)
+    spot_dye = rng.randint(-1, n_dyes - 1, n_spots)
+    # Spots are noisy positive multiples of their dye spectrum, last dye has no spots
+    spot_colours = rng.rand(n_spots, 1) * true_spectrum[spot_dye] + 0.01 * rng.randn(n_spots, n_channels)
+    dye_spectrum = fine_tune_dye_spectra(spot_colours, spot_dye, n_dyes)
+    assert dye_spectrum.shape == (n_dyes, n_channels)
+    for d in range(n_dyes - 1):
+        d_spots = spot_colours[spot_dye == d]
+        eig_val, eig_vec = np.linalg.eig(d_spots.T @ d_spots)
+        expected = np.real(eig_vec[:, np.argmax(eig_val)])
+        expected = expected / np.linalg.norm(expected) * np.sign(np.median(d_spots @ expected))
+        assert np.allclose(dye_spectrum[d], expected)
+        assert np.allclose(dye_spectrum[d], true_spectrum[d] / np.linalg.norm(true_spectrum[d]), atol=0.05)
+    assert np.allclose(np.linalg.norm(dye_spectrum, axis=1), 1)
+
+
+def test_compute_bleed_matrix_float32():
+    rng = np.random.RandomState(0)
+    n_spots, n_rounds, n_channels, n_dyes = 300, 3, 7, 7
+    true_spectrum = rng.rand(n_channels, n_dyes) + 5 * np.eye(n_channels, n_dyes)
+    true_spectrum = true_spectrum / np.linalg.norm(true_spectrum, axis=0)
+    spot_dye = rng.randint(0, n_dyes, (n_spots, n_rounds))
+    spot_colours = rng.rand(n_spots, n_rounds, 1) * true_spectrum.T[spot_dye]
+    spot_tile = np.zeros(n_spots, dtype=int)
+    bleed_matrix, _ = compute_bleed_matrix(true_spectrum, spot_colours, spot_tile, 1)
+    bleed_matrix_32, all_dye_score_32 = compute_bleed_matrix(true_spectrum, spot_colours.astype(np.float32),
+                                                             spot_tile, 1)
+    assert all_dye_score_32.dtype == np.float32
+    assert np.allclose(bleed_matrix_32, bleed_matrix, atol=1e-5)
+    assert np.allclose(bleed_matrix[0, 0], true_spectrum / np.linalg.norm(true_spectrum), atol=1e-5)
@@ -0,0 +1,21 @@
+from coppafish.call_spots.dot_product import dot_product_score, gene_prob_score
+
+import numpy as np
+
+
+def test_zero_spot_colours():
+    rng = np.random.RandomState(0)
+    n_spots, n_genes, n_rounds, n_channels = 5, 3, 4, 3
+    spot_colours = rng.rand(n_spots, n_rounds, n_channels)
+    # Spot 0 is zero in every round, spot 1 is zero only in round 2
+    spot_colours[0] = 0
+    spot_colours[1, 2] = 0
+    bled_codes = rng.rand(n_genes, n_rounds, n_channels)
+    bled_codes = bled_codes / np.linalg.norm(bled_codes, axis=(1, 2), keepdims=True)
+    gene_no, gene_score, gene_score_second = dot_product_score(spot_colours, bled_codes)
+    assert not np.isnan(gene_score).any()
+    assert gene_score[0] == 0 and gene_score_second[0] == 0
+    probability = gene_prob_score(spot_colours, bled_codes)
+    assert not np.isnan(probability).any()
+    assert np.allclose(probability[0], 1 / n_genes)
+    assert np.allclose(probability.sum(axis=1), 1)
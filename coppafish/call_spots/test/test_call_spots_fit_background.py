@@ -38,6 +38,10 @@ def test_fit_background():
     assert background_vectors1.shape == (n_channels, n_rounds, n_channels), \
         'Expected coefs to have shape n_channels x n_spots x n_channels'
     assert np.allclose(residual1, 0), 'Expected all residuals to become near zero after background fitting'
+    background_vectors_expected = np.repeat(np.expand_dims(np.eye(n_channels), axis=1), n_rounds, axis=1)
+    background_vectors_expected /= np.linalg.norm(background_vectors_expected, axis=(1, 2), keepdims=True)
+    assert np.allclose(background_vectors1, background_vectors_expected), \
+        'Expected background vector c to be constant in channel c of every round with an L2 norm of 1'
     # Test weight_shift by seeing if it reduces the variance when increased
     spot_colours = rng.random((n_spots, n_rounds, n_channels)) * 10
     residual1, coef1, background_vectors1 = fit_background(spot_colours, weight_shift=0)
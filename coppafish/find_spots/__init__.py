@@ -1,5 +1,5 @@
 from .base import get_isolated, check_neighbour_intensity, spot_yxz, spot_isolated, get_isolated_points, \
-    load_spot_info, filter_intense_spots
+    load_spot_info, filter_intense_spots, morton_order
 from .check_spots import check_n_spots
 try:
     from .detect_optimised import detect_spots
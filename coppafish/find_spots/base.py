@@ -76,7 +76,7 @@ def spot_isolated(isolated_spots: np.ndarray, tile: int, ref_round: int, ref_cha
 
 
 def get_isolated(image: np.ndarray, spot_yxz: np.ndarray, thresh: float, radius_inner: float, radius_xy: float,
-                 radius_z: Optional[float] = None) -> np.ndarray:
+                 radius_z: Optional[float] = None, image_shift: int = 0) -> np.ndarray:
     """
     Determines whether each spot in ```spot_yxz``` is isolated by getting the value of image after annular filtering
     at each location in ```spot_yxz```.
@@ -93,6 +93,9 @@ def get_isolated(image: np.ndarray, spot_yxz: np.ndarray, thresh: float, radius_
         radius_xy: Outer radius of annulus filtering kernel in xy direction.
         radius_z: Outer radius of annulus filtering kernel in z direction.
             If ```None```, 2D filter is used.
+        image_shift: ```image``` is treated as ```image - image_shift```, e.g. for a tile loaded with
+            ```apply_shift=False``` this is ```tile_pixel_value_shift```. This is removed from the filtered values,
+            so no shifted copy of ```image``` is made.
 
     Returns:
         ```bool [n_peaks]```.
@@ -101,7 +104,9 @@ def get_isolated(image: np.ndarray, spot_yxz: np.ndarray, thresh: float, radius_
     """
     se = utils.strel.annulus(radius_inner, radius_xy, radius_z)
     # With just coords, takes about 3s for 50 z-planes.
-    isolated = utils.morphology.imfilter_coords(image, se, spot_yxz, padding=0, corr_or_conv='corr') / np.sum(se)
+    # Padding with image_shift is the same as padding image - image_shift with 0.
+    isolated = utils.morphology.imfilter_coords(image, se, spot_yxz, padding=image_shift, corr_or_conv='corr')
+    isolated = (isolated - image_shift * np.sum(se)) / np.sum(se)
     return isolated < thresh
 
 
@@ -120,7 +125,7 @@ def check_neighbour_intensity(image: np.ndarray, spot_yxz: np.ndarray, thresh: f
         thresh: Spots are indicated as ```False``` if intensity at neighbour to spot location is less than this.
 
     Returns:
-        ```float [n_peaks]```.
+        ```bool [n_peaks]```.
             ```True``` if no neighbours below thresh.
     """
     if image.ndim == 3:
@@ -129,13 +134,11 @@ def check_neighbour_intensity(image: np.ndarray, spot_yxz: np.ndarray, thresh: f
         transforms = [[1, 0], [0, 1], [-1, 0], [0, -1]]
     else:
         raise ValueError(f"image has to have two or three dimensions but given image has {image.ndim} dimensions.")
-    keep = np.zeros((spot_yxz.shape[0], len(transforms)), dtype=bool)
-    for i, t in enumerate(transforms):
-        mod_spot_yx = spot_yxz + t
-        for j in range(image.ndim):
-            mod_spot_yx[:, j] = np.clip(mod_spot_yx[:, j], 0, image.shape[j] - 1)
-        keep[:, i] = image[tuple([mod_spot_yx[:, j] for j in range(image.ndim)])] > thresh
-    return keep.min(axis=1)
+    # Get all neighbours of all spots at once, mod_spot_yx is [n_peaks x n_transforms x image.ndim]
+    mod_spot_yx = spot_yxz[:, np.newaxis, :image.ndim] + np.array(transforms)[np.newaxis]
+    mod_spot_yx = np.clip(mod_spot_yx, 0, np.array(image.shape) - 1)
+    keep = image[tuple([mod_spot_yx[:, :, j] for j in range(image.ndim)])] > thresh
+    return keep.all(axis=1)
 
 
 def get_isolated_points(spot_yxz: np.ndarray, isolation_dist: float) -> np.ndarray:
@@ -174,7 +177,8 @@ def load_spot_info(nbp_file: NotebookPage, nbp_basic: NotebookPage) -> dict:
     """
     if os.path.isfile(nbp_file.spot_details_info):
         raw = np.load(nbp_file.spot_details_info, allow_pickle=True)
-        spot_info = {'spot_yxz': raw.f.arr_0, 'spot_no': raw.f.arr_1, 'isolated': raw.f.arr_2,
+        # isolated is always kept as bool so appending new tiles to it does not change its dtype
+        spot_info = {'spot_yxz': raw.f.arr_0, 'spot_no': raw.f.arr_1, 'isolated': raw.f.arr_2.astype(bool),
                      'completed': raw.f.arr_3}
     else:
         spot_info = {'spot_yxz': np.zeros((0, 3), dtype=np.int16),
@@ -200,12 +204,48 @@ def filter_intense_spots(local_yxz: np.ndarray, spot_intensity: np.ndarray, n_z:
         local_yxz: [n_spots_keep x 3] int array of yxz positions of spots
     """
     keep = np.ones(local_yxz.shape[0], dtype=bool)
-    # Loop over each z plane and keep only the top max_spots spots
-    for z in range(n_z):
+    if local_yxz.shape[1] > 2:
+        z_coords = local_yxz[:, 2]
+    else:
+        # 2D so all spots are on a single z plane
+        z_coords = np.zeros(local_yxz.shape[0], dtype=int)
+    # Only need to consider the z planes which have more than max_spots spots on them
+    n_spots_z = np.bincount(z_coords, minlength=n_z)
+    for z in np.where(n_spots_z > max_spots)[0]:
         # If the number of spots on this z-plane is > max_spots (500 by default for 3D) then we
-        # set the intensity threshold to the 500th most intense spot and take the top 500 values
-        if np.sum(local_yxz[:, 2] == z) > max_spots:
-            intensity_thresh = np.sort(spot_intensity[local_yxz[:, 2] == z])[-max_spots]
-            keep[np.logical_and(local_yxz[:, 2] == z, spot_intensity < intensity_thresh)] = False
+        # set the intensity threshold to the 500th most intense spot and take the top 500 values.
+        # np.partition finds this value in O(n) time, no need to sort all the spots on the z-plane.
+        in_z = np.where(z_coords == z)[0]
+        intensity_thresh = np.partition(spot_intensity[in_z], -max_spots)[-max_spots]
+        keep[in_z[spot_intensity[in_z] < intensity_thresh]] = False
+
+    return local_yxz[keep]
+
+
+def morton_order(spot_yxz: np.ndarray) -> np.ndarray:
+    """
+    Finds the order which sorts spots by their Morton (Z-order) code, found by interleaving the bits of the y, x and z
+    coordinates. Spots which are close in space are then mostly close in memory too, which makes the KDTree builds and
+    queries on these spots (e.g. in ICP) more cache friendly.
+
+    Args:
+        spot_yxz: `int [n_spots x 3]` or `int [n_spots x 2]`. Non-negative coordinates of spots, each less than `2^21`.
 
-    return local_yxz[keep]
\ No newline at end of file
+    Returns:
+        `int [n_spots]`. `spot_yxz[order]` is sorted by Morton code.
+    """
+    n_dim = spot_yxz.shape[1]
+    morton = np.zeros(spot_yxz.shape[0], dtype=np.uint64)
+    for i in range(n_dim):
+        # Spread the bits of each coordinate out so there are n_dim - 1 zero bits between each of them
+        spread = spot_yxz[:, i].astype(np.uint64) & np.uint64(0x1fffff)
+        if n_dim == 3:
+            for shift, mask in [(32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f),
+                                (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)]:
+                spread = (spread | (spread << np.uint64(shift))) & np.uint64(mask)
+        else:
+            for shift, mask in [(16, 0x0000ffff0000ffff), (8, 0x00ff00ff00ff00ff), (4, 0x0f0f0f0f0f0f0f0f),
+                                (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+                spread = (spread | (spread << np.uint64(shift))) & np.uint64(mask)
+        morton |= spread << np.uint64(n_dim - 1 - i)
+    return np.argsort(morton, kind='stable')
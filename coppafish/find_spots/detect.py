@@ -2,6 +2,7 @@ import warnings
 from typing import Optional, Tuple
 import numpy as np
 from .. import utils
+from .base import check_neighbour_intensity
 
 # This method is a bit silly, I think that the small random number means that the same spot in 2 diff round channels
 # may have a different location depending on where the random number has put it
@@ -12,7 +13,8 @@ from .. import utils
 # structuring element
 def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional[int],
                  radius_z: Optional[int] = None, remove_duplicates: bool = False,
-                 se: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+                 se: Optional[np.ndarray] = None, neighbour_thresh: Optional[float] = None) \
+        -> Tuple[np.ndarray, np.ndarray]:
     """
     Finds local maxima in image exceeding ```intensity_thresh```.
     This is achieved through a dilation being run on the whole image.
@@ -31,6 +33,8 @@ def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional
         se: ```int [se_sz_y x se_sz_x x se_sz_z]```.
             Can give structuring element manually rather than using a cuboid element.
             Must only contain zeros and ones.
+        neighbour_thresh: If given, spots are only kept if all their face neighbours (6 in 3D, 4 in 2D) have
+            ```pixel_value > neighbour_thresh```, the same as ```check_neighbour_intensity```.
 
     Returns:
         - ```peak_yxz``` - ```int [n_peaks x image.ndim]```.
@@ -51,6 +55,7 @@ def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional
         se = se[:, :, mid_z]
 
     small = 1e-6  # for computing local maxima: shouldn't matter what it is (keep below 0.01 for int image).
+    image_raw = image
     if remove_duplicates:
         # perturb image by small amount so two neighbouring pixels that did have the same value now differ slightly.
         # hence when find maxima, will only get one of the pixels not both.
@@ -64,4 +69,7 @@ def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional
     peak_pos = np.where(spots)
     peak_yxz = np.concatenate([coord.reshape(-1, 1) for coord in peak_pos], axis=1)
     peak_intensity = image[spots]
+    if neighbour_thresh is not None:
+        keep = check_neighbour_intensity(image_raw, peak_yxz, neighbour_thresh)
+        peak_yxz, peak_intensity = peak_yxz[keep], peak_intensity[keep]
     return peak_yxz, peak_intensity
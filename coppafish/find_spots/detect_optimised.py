@@ -1,5 +1,4 @@
 import warnings
-from functools import partial
 from typing import Optional, Tuple, List
 import jax
 import numpy as np
@@ -8,7 +7,8 @@ from .. import utils
 
 
 def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional[int], radius_z: Optional[int] = None,
-                 remove_duplicates: bool = False, se: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+                 remove_duplicates: bool = False, se: Optional[np.ndarray] = None,
+                 neighbour_thresh: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
     """
     Finds local maxima in image exceeding ```intensity_thresh```.
     This is achieved by looking at neighbours of pixels above intensity_thresh.
@@ -27,6 +27,9 @@ def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional
         se: ```int [se_sz_y x se_sz_x x se_sz_z]```.
             Can give structuring element manually rather than using a cuboid element.
             Must only contain zeros and ones.
+        neighbour_thresh: If given, spots are only kept if all their face neighbours (6 in 3D, 4 in 2D) have
+            ```pixel_value > neighbour_thresh```, the same as ```check_neighbour_intensity```. This is done while
+            finding the local maxima so the image is not read again.
 
     Returns:
         - ```peak_yxz``` - ```int [n_peaks x image.ndim]```.
@@ -38,20 +41,10 @@ def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional
         # Default is a cuboid se of all ones as is quicker than disk and very similar results.
         if radius_z is not None:
             se = np.ones((2*radius_xy-1, 2*radius_xy-1, 2*radius_z-1), dtype=int)
-            pad_size_z = radius_z-1
         else:
             se = np.ones((2*radius_xy-1, 2*radius_xy-1), dtype=int)
-            pad_size_z = 0
-        pad_size_y = radius_xy - 1
-        pad_size_x = radius_xy - 1
     else:
         se = utils.morphology.ensure_odd_kernel(se)
-        pad_size_y = int((se.shape[0]-1)/2)
-        pad_size_x = int((se.shape[1]-1)/2)
-        if se.ndim == 3:
-            pad_size_z = int((se.shape[2] - 1) / 2)
-        else:
-            pad_size_z = 0
     if image.ndim == 2 and se.ndim == 3:
         mid_z = int(np.floor((se.shape[2]-1)/2))
         warnings.warn(f"2D image provided but 3D filter asked for.\n"
@@ -76,8 +69,15 @@ def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional
     consider_intensity = image[consider_yxz]
     consider_yxz = list(consider_yxz)
 
-    keep = np.asarray(get_local_maxima_jax(image, se_shifts, pad_size_y, pad_size_x, pad_size_z, consider_yxz,
-                                           consider_intensity))
+    # jax compiles get_local_maxima_jax again for every new n_consider. So that this does not happen for every image,
+    # pad the pixels to consider up to the next power of 2, the padded pixels are then ignored.
+    n_consider_pad = int(2 ** np.ceil(np.log2(np.clip(n_consider, 1, None))))
+    consider_yxz_pad = [np.pad(consider_yxz[i], (0, n_consider_pad - n_consider)) for i in range(image.ndim)]
+    consider_intensity_pad = np.pad(consider_intensity, (0, n_consider_pad - n_consider))
+    if neighbour_thresh is None:
+        neighbour_thresh = -np.inf
+    keep = np.asarray(get_local_maxima_jax(image, se_shifts, consider_yxz_pad, consider_intensity_pad,
+                                           neighbour_thresh))[:n_consider]
     if remove_duplicates:
         peak_intensity = np.round(consider_intensity[keep]).astype(int)
     else:
@@ -86,37 +86,44 @@ def detect_spots(image: np.ndarray, intensity_thresh: float, radius_xy: Optional
     return peak_yxz, peak_intensity
 
 
-@partial(jax.jit, static_argnums=(2, 3, 4))
+@jax.jit
 def get_local_maxima_jax(image: jnp.ndarray, se_shifts: Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray],
-                         pad_size_y: int, pad_size_x: int, pad_size_z: int,
-                         consider_yxz: List[jnp.ndarray], consider_intensity: jnp.ndarray) -> jnp.ndarray:
+                         consider_yxz: List[jnp.ndarray], consider_intensity: jnp.ndarray,
+                         neighbour_thresh: float = -np.inf) -> jnp.ndarray:
     """
     Finds the local maxima from a given set of pixels to consider.
+    Pixels outside the image are treated as zero, but the image is not padded, so no copy of it is made.
+    Pixels which have a face neighbour with value not above `neighbour_thresh` are also removed, as in
+    `check_neighbour_intensity` (neighbours outside the image are clipped to the image edge).
 
     Args:
         image: ```float [n_y x n_x x n_z]```.
             ```image``` to find spots on.
         se_shifts: `(image.ndim x  int [n_shifts])`.
             y, x, z shifts which indicate neighbourhood about each spot where local maxima search carried out.
-        pad_size_y: How much to zero pad image in y.
-        pad_size_x: How much to zero pad image in x.
-        pad_size_z: How much to zero pad image in z.
         consider_yxz: `[3 x int [n_consider]]`.
             All yxz coordinates where value in image is greater than an intensity threshold.
         consider_intensity: `float [n_consider]`.
             Value of image at coordinates given by `consider_yxz`.
+        neighbour_thresh: Local maxima with a face neighbour `<= neighbour_thresh` are not kept.
 
     Returns:
         `bool [n_consider]`
-            Whether each point in `consider_yxz` is a local maxima or not.
+            Whether each point in `consider_yxz` is a local maxima, with all face neighbours above
+            `neighbour_thresh`, or not.
     """
-    pad_size = [(pad_size_y, pad_size_y), (pad_size_x, pad_size_x), (pad_size_z, pad_size_z)][:image.ndim]
-    image = jnp.pad(image, pad_size)
-    for i in range(len(pad_size)):
-        consider_yxz[i] = consider_yxz[i] + pad_size[i][0]
     keep = jnp.ones(consider_yxz[0].shape[0], dtype=bool)
     for i in range(se_shifts[0].shape[0]):
-        # Note that in each iteration, only consider coordinates which can still possibly be local maxima.
-        keep = keep * (image[tuple([consider_yxz[j] + se_shifts[j][i] for j in range(image.ndim)])] <=
-                       consider_intensity)
+        shift_yxz = [consider_yxz[j] + se_shifts[j][i] for j in range(image.ndim)]
+        in_image = jnp.ones(consider_yxz[0].shape[0], dtype=bool)
+        for j in range(image.ndim):
+            in_image = in_image * (shift_yxz[j] >= 0) * (shift_yxz[j] < image.shape[j])
+            shift_yxz[j] = jnp.clip(shift_yxz[j], 0, image.shape[j] - 1)
+        neighbour_intensity = jnp.where(in_image, image[tuple(shift_yxz)], 0)
+        keep = keep * (neighbour_intensity <= consider_intensity)
+    for j in range(image.ndim):
+        for step in [-1, 1]:
+            shift_yxz = list(consider_yxz)
+            shift_yxz[j] = jnp.clip(consider_yxz[j] + step, 0, image.shape[j] - 1)
+            keep = keep * (image[tuple(shift_yxz)] > neighbour_thresh)
     return keep
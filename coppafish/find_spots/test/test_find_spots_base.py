@@ -0,0 +1,62 @@
+from coppafish.find_spots.base import filter_intense_spots, check_neighbour_intensity, morton_order, get_isolated
+
+import numpy as np
+
+
+def test_filter_intense_spots():
+    rng = np.random.RandomState(0)
+    n_z = 4
+    max_spots = 10
+    n_spots = 100
+    local_yxz = np.zeros((n_spots, 3), dtype=int)
+    local_yxz[:, :2] = rng.randint(0, 50, size=(n_spots, 2))
+    # Put most spots on z plane 0 so only that plane gets filtered
+    local_yxz[:, 2] = np.append(np.zeros(n_spots - 5, dtype=int), np.arange(5) % n_z)
+    spot_intensity = rng.permutation(n_spots).astype(float)
+    output = filter_intense_spots(local_yxz, spot_intensity, n_z, max_spots)
+    in_z = local_yxz[:, 2] == 0
+    expected_z0 = local_yxz[in_z][np.argsort(spot_intensity[in_z])[-max_spots:]]
+    assert np.sum(output[:, 2] == 0) == max_spots
+    assert np.allclose(np.sort(output[output[:, 2] == 0], axis=0), np.sort(expected_z0, axis=0))
+    # z planes with fewer than max_spots spots are left alone
+    assert np.allclose(output[output[:, 2] != 0], local_yxz[~in_z])
+
+
+def test_check_neighbour_intensity():
+    image = np.ones((5, 6, 4))
+    spot_yxz = np.array([[0, 0, 0], [2, 3, 1], [4, 5, 3], [2, 2, 2]])
+    # Neighbour below thresh next to the last spot only
+    image[2, 2, 3] = -1
+    assert np.array_equal(check_neighbour_intensity(image, spot_yxz, thresh=0), [True, True, True, False])
+    # 2D, only yx coordinates of spot_yxz used
+    image_2d = np.ones((5, 6))
+    image_2d[0, 1] = 0
+    assert np.array_equal(check_neighbour_intensity(image_2d, spot_yxz, thresh=0), [False, True, True, True])
+
+
+def test_morton_order():
+    # 2 x 2 x 2 cube, Morton order is the binary number formed by the yxz bits
+    yxz = np.array([[y, x, z] for y in range(2) for x in range(2) for z in range(2)])
+    rng = np.random.RandomState(0)
+    shuffle = rng.permutation(yxz.shape[0])
+    assert np.array_equal(yxz[shuffle][morton_order(yxz[shuffle])], yxz)
+    # The top bit of any coordinate beats all lower bits of the others
+    yxz = np.array([[0, 0, 4], [3, 3, 3], [1, 0, 0], [0, 7, 0]])
+    assert np.array_equal(morton_order(yxz), [2, 1, 0, 3])
+    # 2D
+    yx = np.array([[1, 1], [0, 1], [1, 0], [0, 0]])
+    assert np.array_equal(morton_order(yx), [3, 1, 2, 0])
+
+
+def test_get_isolated_image_shift():
+    rng = np.random.RandomState(0)
+    image_shift = 15000
+    image = rng.randint(0, 200, size=(30, 40, 5))
+    spot_yxz = np.array([rng.randint(0, image.shape[i], 50) for i in range(3)]).T
+    # Include spots on the edge, where the annulus goes outside the image
+    spot_yxz[:5] = 0
+    expected = get_isolated(image - 100, spot_yxz, 5, 2, 4, 2)
+    output = get_isolated((image - 100 + image_shift).astype(np.uint16), spot_yxz, 5, 2, 4, 2,
+                          image_shift=image_shift)
+    assert not expected.all() and expected.any()
+    assert np.array_equal(output, expected)
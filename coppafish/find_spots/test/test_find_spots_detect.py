@@ -0,0 +1,30 @@
+from coppafish.find_spots import detect, detect_optimised
+from coppafish.find_spots.base import check_neighbour_intensity
+
+import numpy as np
+
+
+def test_detect_spots_optimised():
+    rng = np.random.RandomState(0)
+    for shape, radius_z in [((40, 50, 7), 2), ((40, 50), None)]:
+        image = rng.rand(*shape)
+        # The non-optimised dilation is the reference for the jax local maxima search
+        peak_yxz, peak_intensity = detect.detect_spots(image, 0.5, 3, radius_z)
+        peak_yxz_optimised, peak_intensity_optimised = detect_optimised.detect_spots(image, 0.5, 3, radius_z)
+        assert np.array_equal(peak_yxz, peak_yxz_optimised)
+        assert np.allclose(peak_intensity, peak_intensity_optimised)
+
+
+def test_detect_spots_neighbour_thresh():
+    rng = np.random.RandomState(0)
+    for shape, radius_z in [((40, 50, 7), 2), ((40, 50), None)]:
+        image = rng.randint(0, 100, size=shape)
+        for detect_module in [detect, detect_optimised]:
+            # Same as removing spots with check_neighbour_intensity afterwards
+            peak_yxz, peak_intensity = detect_module.detect_spots(image, 60, 3, radius_z, True)
+            keep = check_neighbour_intensity(image, peak_yxz, 20)
+            peak_yxz_thresh, peak_intensity_thresh = detect_module.detect_spots(image, 60, 3, radius_z, True,
+                                                                                neighbour_thresh=20)
+            assert 0 < peak_yxz_thresh.shape[0] < peak_yxz.shape[0]
+            assert np.array_equal(peak_yxz_thresh, peak_yxz[keep])
+            assert np.array_equal(peak_intensity_thresh, peak_intensity[keep])
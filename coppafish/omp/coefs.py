@@ -1,6 +1,7 @@
 import numpy as np
+import scipy.linalg
 from coppafish.call_spots import fit_background, dot_product_score
-from typing import Tuple, Union
+from typing import Tuple, Union, Optional
 from tqdm import tqdm
 import warnings
 
@@ -28,11 +29,44 @@ def fit_coefs(bled_codes: np.ndarray, pixel_colors: np.ndarray, genes: np.ndarra
 
     """
     n_pixels = pixel_colors.shape[1]
-    residual = np.zeros((n_pixels, pixel_colors.shape[0]))
-    coefs = np.zeros_like(genes, dtype=float)
-    for s in range(n_pixels):
-        coefs[s] = np.linalg.lstsq(bled_codes[:, genes[s]], pixel_colors[:, s], rcond=None)[0]
-        residual[s] = pixel_colors[:, s] - bled_codes[:, genes[s]] @ coefs[s]
+    residual = np.zeros((n_pixels, pixel_colors.shape[0]), dtype=pixel_colors.dtype)
+    coefs = np.zeros_like(genes, dtype=pixel_colors.dtype)
+    # Many pixels have the same genes added, so group pixels by their set of genes and solve one least squares problem
+    # for all pixels in each group, rather than one per pixel. Genes are sorted so the order they were added in does
+    # not matter, then the coefs are put back in the order of genes.
+    genes_sort_ind = np.argsort(genes, axis=1)
+    genes_sorted = np.take_along_axis(genes, genes_sort_ind, axis=1)
+    group_genes, pixel_group = np.unique(genes_sorted, axis=0, return_inverse=True)
+    pixel_group = pixel_group.ravel()
+    coefs_sorted = np.zeros_like(coefs)
+    # Solving the normal equations squares the condition number of the codes, so the Cholesky solution is only used if
+    # the gram matrix is well conditioned, estimated from the ratio of the smallest to largest diagonal of L squared.
+    gram_cond_thresh = np.sqrt(np.finfo(np.result_type(bled_codes, pixel_colors)).eps)
+    # Pixels of each group are found by sorting by group once and splitting, rather than searching all pixels per group.
+    pixel_group_order = np.argsort(pixel_group, kind='stable')
+    pixel_group_split = np.split(pixel_group_order, np.cumsum(np.bincount(pixel_group))[:-1])
+    for group_gene_set, group_pixels in zip(group_genes, pixel_group_split):
+        group_codes = bled_codes[:, group_gene_set]
+        group_pixel_colors = pixel_colors[:, group_pixels]
+        # Solve the normal equations with a Cholesky factorisation of the small n_genes_add x n_genes_add gram
+        # matrix, which is much cheaper than a QR of the n_rounds*n_channels x n_genes_add codes for every group.
+        try:
+            gram_cho = scipy.linalg.cho_factor(group_codes.T @ group_codes)
+            gram_cho_diag_sq = np.diag(gram_cho[0]) ** 2
+            well_conditioned = gram_cho_diag_sq.min() > gram_cond_thresh * gram_cho_diag_sq.max()
+        except np.linalg.LinAlgError:
+            well_conditioned = False
+        if well_conditioned:
+            group_coefs = scipy.linalg.cho_solve(gram_cho, group_codes.T @ group_pixel_colors)
+        else:
+            # Gram matrix is not positive definite or is badly conditioned if the codes are (nearly) linearly
+            # dependent. gelsy (QR with column pivoting) still gives the minimum norm solution, and is faster than
+            # the default SVD based gelsd.
+            group_coefs = scipy.linalg.lstsq(group_codes, group_pixel_colors, lapack_driver='gelsy',
+                                             check_finite=False)[0]
+        coefs_sorted[group_pixels] = group_coefs.T
+        residual[group_pixels] = (group_pixel_colors - group_codes @ group_coefs).T
+    np.put_along_axis(coefs, genes_sort_ind, coefs_sorted, axis=1)
     return residual, coefs
 
 
@@ -62,25 +96,40 @@ def fit_coefs_weight(bled_codes: np.ndarray, pixel_colors: np.ndarray, genes: np
             coefficient found through least squares fitting for each gene.
 
     """
-    n_pixels = pixel_colors.shape[1]
-    residual = np.zeros((n_pixels, pixel_colors.shape[0]))
-    coefs = np.zeros_like(genes, dtype=float)
     pixel_colors = pixel_colors * weight.transpose()
-    for s in range(n_pixels):
-        bled_codes_s = bled_codes[:, genes[s]] * weight[s][:, np.newaxis]
-        coefs[s] = np.linalg.lstsq(bled_codes_s, pixel_colors[:, s], rcond=None)[0]
-        residual[s] = pixel_colors[:, s] - bled_codes_s @ coefs[s]
+    # Weights differ for every pixel, so pixels cannot share a fit. Instead, the weighted codes of all pixels are
+    # gathered as an n_pixels x n_genes_add x (n_rounds x n_channels) array and the normal equations of every pixel are
+    # solved with one batched call, rather than looping over pixels in python.
+    bled_codes_weight = bled_codes.transpose()[genes] * weight[:, np.newaxis]
+    gram = np.einsum('sgi,shi->sgh', bled_codes_weight, bled_codes_weight)
+    # Solving the normal equations squares the condition number of the codes, so they are only solved for pixels whose
+    # gram matrix is well conditioned, i.e. the ratio of its smallest to largest eigenvalue is above sqrt(eps).
+    gram_eig = np.linalg.eigvalsh(gram)
+    gram_cond_thresh = np.sqrt(np.finfo(gram.dtype).eps)
+    well_conditioned = gram_eig[:, 0] > gram_cond_thresh * gram_eig[:, -1]
+    coefs = np.zeros_like(genes, dtype=pixel_colors.dtype)
+    coefs[well_conditioned] = np.linalg.solve(
+        gram[well_conditioned],
+        np.einsum('sgi,is->sg', bled_codes_weight[well_conditioned],
+                  pixel_colors[:, well_conditioned])[..., np.newaxis])[..., 0]
+    for s in np.where(np.invert(well_conditioned))[0]:
+        # Gram matrix is singular or badly conditioned if the weighted codes of the pixel are (nearly) linearly
+        # dependent. gelsy (QR with column pivoting) still gives the minimum norm solution.
+        coefs[s] = scipy.linalg.lstsq(bled_codes_weight[s].transpose(), pixel_colors[:, s], lapack_driver='gelsy',
+                                      check_finite=False)[0]
+    residual = pixel_colors.transpose() - np.einsum('sgi,sg->si', bled_codes_weight, coefs)
     residual = residual / weight
     return residual, coefs
 
 
 def get_best_gene_base(residual_pixel_colors: np.ndarray, all_bled_codes: np.ndarray,
                        norm_shift: float, score_thresh: float, inverse_var: np.ndarray,
-                       ignore_genes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+                       ignore_genes: Optional[np.ndarray],
+                       ignore_genes_all: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Computes the `dot_product_score` between `residual_pixel_color` and each code in `all_bled_codes`.
-    If `best_score` is less than `score_thresh` or if the corresponding `best_gene` is in `ignore_genes`,
-    then `pass_score_thresh` will be False.
+    If `best_score` is less than `score_thresh` or if the corresponding `best_gene` is in `ignore_genes`
+    or `ignore_genes_all`, then `pass_score_thresh` will be False.
 
     Args:
         residual_pixel_colors: `float [n_pixels x (n_rounds x n_channels)]`.
@@ -97,6 +146,10 @@ def get_best_gene_base(residual_pixel_colors: np.ndarray, all_bled_codes: np.nda
             Used as `weight_squared` when computing `dot_product_score`.
         ignore_genes: `int [n_pixels x n_genes_ignore]`.
             If `best_gene[s]` is one of these, `pass_score_thresh[s]` will be `False`.
+            `None` if no genes are ignored per pixel.
+        ignore_genes_all: `int [n_genes_ignore_all]`.
+            Genes ignored by every pixel e.g. background. These are not tiled to `[n_pixels x n_genes_ignore_all]`
+            and compared for every pixel, as `best_gene` only needs to be looked up once in them.
 
     Returns:
         - best_gene - `int [n_pixels]`.
@@ -110,8 +163,15 @@ def get_best_gene_base(residual_pixel_colors: np.ndarray, all_bled_codes: np.nda
     # calculate score including background genes as if best gene is background, then stop iteration.
     best_gene, best_score, _ = dot_product_score(residual_pixel_colors, all_bled_codes, inverse_var, norm_shift)
     # if best_gene is in ignore_gene, set score below score_thresh.
-    is_ignore_gene = (best_gene[:, np.newaxis] == ignore_genes).any(axis=1)
-    best_score = best_score * np.invert(is_ignore_gene)
+    if ignore_genes is None:
+        is_ignore_gene = np.zeros(best_gene.shape, dtype=bool)
+    else:
+        is_ignore_gene = (best_gene[:, np.newaxis] == ignore_genes).any(axis=1)
+    if ignore_genes_all is not None:
+        is_ignore_gene |= np.isin(best_gene, ignore_genes_all)
+    # Only the best score of each active pixel is looked at, so zero the ignored ones in place, rather than
+    # building an inverted mask and a new score array.
+    best_score[is_ignore_gene] = 0
     pass_score_thresh = np.abs(best_score) > score_thresh
     return best_gene, pass_score_thresh, best_score
 
@@ -156,18 +216,20 @@ def get_best_gene_first_iter(residual_pixel_colors: np.ndarray, all_bled_codes:
             `dot_product_score` for spot `s` with gene `best_gene[s]`.
 
     """
-    background_var = np.square(background_coefs) @ np.square(all_bled_codes[background_genes]) * alpha + beta ** 2
-    ignore_genes = np.tile(background_genes, [background_var.shape[0], 1])
+    background_var = np.square(background_coefs) @ np.square(all_bled_codes[background_genes])
+    background_var *= alpha
+    background_var += beta ** 2
     best_gene, pass_score_thresh, best_score = \
         get_best_gene_base(residual_pixel_colors, all_bled_codes, norm_shift, score_thresh, 1 / background_var,
-                           ignore_genes)
+                           None, background_genes)
     return best_gene, pass_score_thresh, background_var, best_score
 
 
 def get_best_gene(residual_pixel_colors: np.ndarray, all_bled_codes: np.ndarray, coefs: np.ndarray,
                   genes_added: np.array, norm_shift: float, score_thresh: float, alpha: float,
-                  background_genes: np.ndarray,
-                  background_var: np.array) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+                  background_genes: np.ndarray, background_var: np.array,
+                  all_bled_codes_sq: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                                                                         np.ndarray]:
     """
     Finds the `best_gene` to add next to each pixel based on the dot product score with each `bled_code`.
     If `best_gene[s]` is in `background_genes`, already in `genes_added[s]` or `best_score[s] < score_thresh`,
@@ -202,6 +264,9 @@ def get_best_gene(residual_pixel_colors: np.ndarray, all_bled_codes: np.ndarray,
         background_var: `float [n_pixels x (n_rounds x n_channels)]`.
             Contribution of background genes to variance (which does not change throughout omp iterations)  i.e.
             `background_coefs**2 @ all_bled_codes[background_genes]**2 * alpha + beta ** 2`.
+        all_bled_codes_sq: `float [n_genes x (n_rounds x n_channels)]`.
+            `all_bled_codes ** 2`. If not given, it is computed here. Given by `get_all_coefs` so it is only computed
+            once, rather than every iteration.
 
     Returns:
         - best_gene - `int [n_pixels]`.
@@ -215,84 +280,42 @@ def get_best_gene(residual_pixel_colors: np.ndarray, all_bled_codes: np.ndarray,
             `dot_product_score` for spot `s` with gene `best_gene[s]`.
     """
 
-    n_pixels, n_genes_added = genes_added.shape
-    n_genes = all_bled_codes.shape[0]
-    coefs_all = np.zeros((n_pixels, n_genes))
-    pixel_ind = np.repeat(np.arange(n_pixels), n_genes_added)
-    coefs_all[(pixel_ind, genes_added.flatten())] = coefs.flatten()
-
-    inverse_var = 1 / (coefs_all ** 2 @ all_bled_codes ** 2 * alpha + background_var)
-    ignore_genes = np.concatenate((genes_added, np.tile(background_genes, [n_pixels, 1])), axis=1)
+    if all_bled_codes_sq is None:
+        all_bled_codes_sq = all_bled_codes ** 2
+
+    # Only the genes added to each pixel contribute to its variance, so contract over just these, rather than over a
+    # dense n_pixels x n_genes coefficient matrix which is almost all zeros.
+    # The variance is scaled, shifted and inverted in place to avoid an n_pixels x (n_rounds x n_channels) temporary
+    # at each step.
+    inverse_var = np.einsum('sg,sgi->si', coefs ** 2, all_bled_codes_sq[genes_added])
+    inverse_var *= alpha
+    inverse_var += background_var
+    np.reciprocal(inverse_var, out=inverse_var)
+    # Only the few genes added to each pixel are compared per pixel. Background genes are the same for all pixels,
+    # so are not tiled and concatenated onto genes_added at every iteration.
     best_gene, pass_score_thresh, best_score = \
-        get_best_gene_base(residual_pixel_colors, all_bled_codes, norm_shift, score_thresh, inverse_var, ignore_genes)
+        get_best_gene_base(residual_pixel_colors, all_bled_codes, norm_shift, score_thresh, inverse_var, genes_added,
+                           background_genes)
 
     return best_gene, pass_score_thresh, inverse_var, best_score
 
 
-def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_shift: float,
-                  dp_shift: float, dp_thresh: float, alpha: float, beta: float, max_genes: int,
-                  weight_coef_fit: bool = False,
-                  track: bool = False) -> Union[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, dict]]:
+def _get_all_coefs_block(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_shift: float,
+                         dp_shift: float, dp_thresh: float, alpha: float, beta: float, max_genes: int,
+                         weight_coef_fit: bool, track: bool, dtype: type,
+                         verbose: bool) -> Union[Tuple[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, dict]]:
     """
-    This performs omp on every pixel, the stopping criterion is that the dot_product_score
-    when selecting the next gene to add exceeds dp_thresh or the number of genes added to the pixel exceeds max_genes.
-
-    !!! note
-        Background vectors are fitted first and then not updated again.
+    Performs omp on one block of pixels. See `get_all_coefs` for details of the arguments and returns.
 
     Args:
-        pixel_colors: `float [n_pixels x n_rounds x n_channels]`.
-            Pixel colors normalised to equalise intensities between channels (and rounds).
-        bled_codes: `float [n_genes x n_rounds x n_channels]`.
-            `bled_codes` such that `spot_color` of a gene `g`
-            in round `r` is expected to be a constant multiple of `bled_codes[g, r]`.
-        background_shift: When fitting background,
-            this is applied to weighting of each background vector to limit boost of weak pixels.
-        dp_shift: When finding `dot_product_score` between residual `pixel_colors` and `bled_codes`,
-            this is applied to normalisation of `pixel_colors` to limit boost of weak pixels.
-        dp_thresh: `dot_product_score` of the best gene for a pixel must exceed this
-            for that gene to be added at each iteration.
-        alpha: Used for `fitting_standard_deviation`, by how much to increase variance as genes added.
-        beta: Used for `fitting_standard_deviation`, the variance with no genes added (`coef=0`) is `beta**2`.
-        max_genes: Maximum number of genes that can be added to a pixel i.e. number of iterations of OMP.
-        weight_coef_fit: If False, coefs are found through normal least squares fitting.
-            If True, coefs are found through weighted least squares fitting using 1/sigma as the weight factor.
-        track: If `True` and one pixel, info about genes added at each step returned.
-
-    Returns:
-        gene_coefs - `float32 [n_pixels x n_genes]`.
-            `gene_coefs[s, g]` is the weighting of pixel `s` for gene `g` found by the omp algorithm. Most are zero.
-        background_coefs - `float32 [n_pixels x n_channels]`.
-            coefficient value for each background vector found for each pixel.
-        track_info - dictionary containing info about genes added at each step returned if `track == True` -
-
-            - `background_codes` - `float [n_channels x n_rounds x n_channels]`.
-                `background_codes[c]` is the background vector for channel `c` with L2 norm of 1.
-            - `background_coefs` - `float [n_channels]`.
-                `background_coefs[c]` is the coefficient value for `background_codes[c]`.
-            - `gene_added` - `int [n_genes_added + 2]`.
-                `gene_added[0]` and `gene_added[1]` are -1.
-                `gene_added[2+i]` is the `ith` gene that was added.
-            - `residual` - `float [(n_genes_added + 2) x n_rounds x n_channels]`.
-                `residual[0]` is the initial `pixel_color`.
-                `residual[1]` is the post background `pixel_color`.
-                `residual[2+i]` is the `pixel_color` after removing gene `gene_added[2+i]`.
-            - `coef` - `float [(n_genes_added + 2) x n_genes]`.
-                `coef[0]` and `coef[1]` are all 0.
-                `coef[2+i]` are the coefficients for all genes after the ith gene has been added.
-            - `dot_product` - `float [n_genes_added + 2]`.
-                `dot_product[0]` and `dot_product[1]` are 0.
-                `dot_product[2+i]` is the dot product for the gene `gene_added[2+i]`.
-            - `inverse_var` - `float [(n_genes_added + 2) x n_rounds x n_channels]`.
-                `inverse_var[0]` and `inverse_var[1]` are all 0.
-                `inverse_var[2+i]` is the weighting used to compute `dot_product[2+i]`,
-                 which down-weights rounds/channels for which a gene has already been fitted.
-
+        verbose: Whether to show a progress bar over the omp iterations.
     """
     n_pixels = pixel_colors.shape[0]
     n_genes, n_rounds, n_channels = bled_codes.shape
+    pixel_colors = np.asarray(pixel_colors, dtype=dtype)
+    bled_codes = np.asarray(bled_codes, dtype=dtype)
 
-    no_verbose = n_pixels < 1000  # show progress bar with more than 1000 pixels.
+    no_verbose = not verbose
     if track:
         return_track = True
         if n_pixels == 1:
@@ -313,6 +336,7 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
     # Fit background and override initial pixel_colors
     gene_coefs = np.zeros((n_pixels, n_genes), dtype=np.float32)  # coefs of all genes and background
     pixel_colors, background_coefs, background_codes = fit_background(pixel_colors, background_shift)
+    background_codes = background_codes.astype(dtype)
 
     if track:
         track_info['residual'][1] = pixel_colors[0]
@@ -326,10 +350,15 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
     # uses residual color as used to find next gene to add.
     bled_codes = bled_codes.reshape((n_genes, -1))
     all_codes = np.concatenate((bled_codes, background_codes.reshape(n_channels, -1)))
-    bled_codes = bled_codes.transpose()
+    # Used for the variance at every iteration, so only square once
+    all_codes_sq = all_codes ** 2
+    # Used for the closed form least squares coefs of the first iteration, where only one gene is fit to each pixel
+    bled_codes_norm_sq = np.einsum('gd,gd->g', bled_codes, bled_codes)
 
     # colors and codes for fit_coefs function (No background as this is not updated again).
     # always uses post background color as coefficients for all genes re-estimated at each iteration.
+    # Codes and colors are kept as [n x (n_rounds x n_channels)] throughout, so each pixel is contiguous when
+    # selecting the pixels to continue with. fit_coefs is given transposed views of these, which need no copy.
     pixel_colors = pixel_colors.reshape((n_pixels, -1))
 
     continue_pixels = np.arange(n_pixels)
@@ -341,13 +370,17 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
                 added_genes, pass_score_thresh, background_variance, best_score = \
                     get_best_gene_first_iter(pixel_colors, all_codes, background_coefs, dp_shift,
                                              dp_thresh, alpha, beta, background_genes)
-                inverse_var = 1 / background_variance
-                pixel_colors = pixel_colors.transpose()
+                if weight_coef_fit or track:
+                    # inverse_var is only needed for the weighted fit, or to record in track_info
+                    inverse_var = 1 / background_variance
             else:
+                # The residual is kept explicitly, rather than only its dot product with each code through the gram
+                # matrix, because the score weights each round/channel of each pixel by its inverse_var, which changes
+                # as genes are added.
                 # only continue with pixels for which dot product score exceeds threshold
                 i_added_genes, pass_score_thresh, inverse_var, best_score = \
                     get_best_gene(residual_pixel_colors, all_codes, i_coefs, added_genes, dp_shift,
-                                  dp_thresh, alpha, background_genes, background_variance)
+                                  dp_thresh, alpha, background_genes, background_variance, all_codes_sq)
 
                 # For pixels with at least one non-zero coef, add to final gene_coefs when fail the thresholding.
                 fail_score_thresh = np.invert(pass_score_thresh)
@@ -356,7 +389,9 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
 
             continue_pixels = continue_pixels[pass_score_thresh]
             n_continue = np.size(continue_pixels)
-            pbar.set_postfix({'n_pixels': n_continue})
+            if verbose:
+                # Only format the postfix when the progress bar is shown, as it is built every iteration of every block
+                pbar.set_postfix({'n_pixels': n_continue})
             if n_continue == 0:
                 if track:
                     track_info['inverse_var'][i + 2] = inverse_var.reshape(n_rounds, n_channels)
@@ -369,9 +404,10 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
                         # Need to usee all_codes here to deal with case where the best gene is background
                         if weight_coef_fit:
                             residual_pixel_colors_fail, i_coefs_fail = \
-                                fit_coefs_weight(all_codes.T, pixel_colors, added_genes_fail, np.sqrt(inverse_var))
+                                fit_coefs_weight(all_codes.T, pixel_colors.T, added_genes_fail, np.sqrt(inverse_var))
                         else:
-                            residual_pixel_colors_fail, i_coefs_fail = fit_coefs(all_codes.T, pixel_colors, added_genes_fail)
+                            residual_pixel_colors_fail, i_coefs_fail = fit_coefs(all_codes.T, pixel_colors.T,
+                                                                                 added_genes_fail)
                         track_info['residual'][i + 2] = residual_pixel_colors_fail.reshape(n_rounds, n_channels)
                         track_info['coef'][i + 2][added_genes_fail] = i_coefs_fail
                     # Only save info where gene is actually added or for final case where not added.
@@ -384,15 +420,24 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
                 added_genes = added_genes[pass_score_thresh, np.newaxis]
             else:
                 added_genes = np.hstack((added_genes[pass_score_thresh], i_added_genes[pass_score_thresh, np.newaxis]))
-            pixel_colors = pixel_colors[:, pass_score_thresh]
+            pixel_colors = pixel_colors[pass_score_thresh]
             background_variance = background_variance[pass_score_thresh]
-            inverse_var = inverse_var[pass_score_thresh]
-
             if weight_coef_fit:
-                residual_pixel_colors, i_coefs = fit_coefs_weight(bled_codes, pixel_colors, added_genes,
+                inverse_var = inverse_var[pass_score_thresh]
+
+            if i == 0 and not weight_coef_fit:
+                # With a single gene per pixel, the least squares coef is just the dot product with its code
+                # divided by the squared norm of the code, so there is no need to solve a system for each gene.
+                best_codes = bled_codes[added_genes[:, 0]]
+                i_coefs = np.einsum('sd,sd->s', pixel_colors, best_codes) / bled_codes_norm_sq[added_genes[:, 0]]
+                i_coefs = i_coefs[:, np.newaxis]
+                best_codes *= i_coefs
+                residual_pixel_colors = pixel_colors - best_codes
+            elif weight_coef_fit:
+                residual_pixel_colors, i_coefs = fit_coefs_weight(bled_codes.T, pixel_colors.T, added_genes,
                                                                   np.sqrt(inverse_var))
             else:
-                residual_pixel_colors, i_coefs = fit_coefs(bled_codes, pixel_colors, added_genes)
+                residual_pixel_colors, i_coefs = fit_coefs(bled_codes.T, pixel_colors.T, added_genes)
 
             if i == max_genes-1:
                 # Add pixels to final gene_coefs when reach end of iteration.
@@ -406,7 +451,6 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
                 track_info['gene_added'][i + 2] = added_genes[0][-1]
 
             pbar.update(1)
-    pbar.close()
     if track:
         # Only return
         no_gene_add_ind = np.where(track_info['gene_added'] == -1)[0]
@@ -416,4 +460,87 @@ def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_s
     if return_track:
         return gene_coefs.astype(np.float32), background_coefs.astype(np.float32), track_info
     else:
-        return gene_coefs.astype(np.float32), background_coefs.astype(np.float32)
\ No newline at end of file
+        return gene_coefs.astype(np.float32), background_coefs.astype(np.float32)
+
+
+def get_all_coefs(pixel_colors: np.ndarray, bled_codes: np.ndarray, background_shift: float,
+                  dp_shift: float, dp_thresh: float, alpha: float, beta: float, max_genes: int,
+                  weight_coef_fit: bool = False, track: bool = False, dtype: type = np.float32,
+                  pixel_block_size: int = 65536) -> Union[Tuple[np.ndarray, np.ndarray],
+                                                          Tuple[np.ndarray, np.ndarray, dict]]:
+    """
+    This performs omp on every pixel, the stopping criterion is that the dot_product_score
+    when selecting the next gene to add exceeds dp_thresh or the number of genes added to the pixel exceeds max_genes.
+
+    !!! note
+        Background vectors are fitted first and then not updated again.
+
+    Args:
+        pixel_colors: `float [n_pixels x n_rounds x n_channels]`.
+            Pixel colors normalised to equalise intensities between channels (and rounds).
+        bled_codes: `float [n_genes x n_rounds x n_channels]`.
+            `bled_codes` such that `spot_color` of a gene `g`
+            in round `r` is expected to be a constant multiple of `bled_codes[g, r]`.
+        background_shift: When fitting background,
+            this is applied to weighting of each background vector to limit boost of weak pixels.
+        dp_shift: When finding `dot_product_score` between residual `pixel_colors` and `bled_codes`,
+            this is applied to normalisation of `pixel_colors` to limit boost of weak pixels.
+        dp_thresh: `dot_product_score` of the best gene for a pixel must exceed this
+            for that gene to be added at each iteration.
+        alpha: Used for `fitting_standard_deviation`, by how much to increase variance as genes added.
+        beta: Used for `fitting_standard_deviation`, the variance with no genes added (`coef=0`) is `beta**2`.
+        max_genes: Maximum number of genes that can be added to a pixel i.e. number of iterations of OMP.
+        weight_coef_fit: If False, coefs are found through normal least squares fitting.
+            If True, coefs are found through weighted least squares fitting using 1/sigma as the weight factor.
+        track: If `True` and one pixel, info about genes added at each step returned.
+        dtype: Float type used for the pixel colors, codes, residuals and coefs while fitting. `float32` by default as
+            pixel colors come from 16 bit images, and this halves the memory of every array touched at each iteration.
+        pixel_block_size: Pixels are fit in blocks of at most this many pixels, so the many arrays of size
+            `[n_pixels x n_rounds x n_channels]` made at each iteration stay small. Without it, these take up a lot of
+            memory and are read back from main memory at every step when there are millions of pixels.
+
+    Returns:
+        gene_coefs - `float32 [n_pixels x n_genes]`.
+            `gene_coefs[s, g]` is the weighting of pixel `s` for gene `g` found by the omp algorithm. Most are zero.
+        background_coefs - `float32 [n_pixels x n_channels]`.
+            coefficient value for each background vector found for each pixel.
+        track_info - dictionary containing info about genes added at each step returned if `track == True` -
+
+            - `background_codes` - `float [n_channels x n_rounds x n_channels]`.
+                `background_codes[c]` is the background vector for channel `c` with L2 norm of 1.
+            - `background_coefs` - `float [n_channels]`.
+                `background_coefs[c]` is the coefficient value for `background_codes[c]`.
+            - `gene_added` - `int [n_genes_added + 2]`.
+                `gene_added[0]` and `gene_added[1]` are -1.
+                `gene_added[2+i]` is the `ith` gene that was added.
+            - `residual` - `float [(n_genes_added + 2) x n_rounds x n_channels]`.
+                `residual[0]` is the initial `pixel_color`.
+                `residual[1]` is the post background `pixel_color`.
+                `residual[2+i]` is the `pixel_color` after removing gene `gene_added[2+i]`.
+            - `coef` - `float [(n_genes_added + 2) x n_genes]`.
+                `coef[0]` and `coef[1]` are all 0.
+                `coef[2+i]` are the coefficients for all genes after the ith gene has been added.
+            - `dot_product` - `float [n_genes_added + 2]`.
+                `dot_product[0]` and `dot_product[1]` are 0.
+                `dot_product[2+i]` is the dot product for the gene `gene_added[2+i]`.
+            - `inverse_var` - `float [(n_genes_added + 2) x n_rounds x n_channels]`.
+                `inverse_var[0]` and `inverse_var[1]` are all 0.
+                `inverse_var[2+i]` is the weighting used to compute `dot_product[2+i]`,
+                 which down-weights rounds/channels for which a gene has already been fitted.
+
+    """
+    n_pixels = pixel_colors.shape[0]
+    if track or n_pixels <= pixel_block_size:
+        # show progress bar with more than 1000 pixels.
+        return _get_all_coefs_block(pixel_colors, bled_codes, background_shift, dp_shift, dp_thresh, alpha, beta,
+                                    max_genes, weight_coef_fit, track, dtype, n_pixels >= 1000)
+
+    n_genes, n_channels = bled_codes.shape[0], bled_codes.shape[2]
+    gene_coefs = np.zeros((n_pixels, n_genes), dtype=np.float32)
+    background_coefs = np.zeros((n_pixels, n_channels), dtype=np.float32)
+    for p in tqdm(range(0, n_pixels, pixel_block_size), desc='Finding OMP coefficients for each block of pixels'):
+        block = slice(p, p + pixel_block_size)
+        gene_coefs[block], background_coefs[block] = \
+            _get_all_coefs_block(pixel_colors[block], bled_codes, background_shift, dp_shift, dp_thresh, alpha, beta,
+                                 max_genes, weight_coef_fit, False, dtype, False)
+    return gene_coefs, background_coefs
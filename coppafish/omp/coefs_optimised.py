@@ -16,8 +16,8 @@ def fit_coefs_single(bled_codes: jnp.ndarray, pixel_color: jnp.ndarray,
     can best explain `pixel_color`.
 
     Args:
-        bled_codes: `float [(n_rounds x n_channels) x n_genes]`.
-            Flattened then transposed bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
+        bled_codes: `float [n_genes x (n_rounds x n_channels)]`.
+            Flattened bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
         pixel_color: `float [(n_rounds x n_channels)]`.
             Flattened `pixel_color` which usually has the shape `[n_rounds x n_channels]`.
         genes: `int [n_genes_add]`.
@@ -29,8 +29,10 @@ def fit_coefs_single(bled_codes: jnp.ndarray, pixel_color: jnp.ndarray,
         - coefs - `float [n_genes_add]`.
             Coefficients found through least squares fitting for each gene.
     """
-    coefs = jnp.linalg.lstsq(bled_codes[:, genes], pixel_color)[0]
-    residual = pixel_color - jnp.matmul(bled_codes[:, genes], coefs)
+    # Gather the codes of genes as rows, which are contiguous, then transpose the small n_genes_add codes
+    codes = bled_codes[genes].transpose()
+    coefs = jnp.linalg.lstsq(codes, pixel_color)[0]
+    residual = pixel_color - jnp.matmul(codes, coefs)
     return residual, coefs
 
 
@@ -39,13 +41,13 @@ def fit_coefs(bled_codes: jnp.ndarray, pixel_colors: jnp.ndarray,
               genes: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
     """
     This finds the least squared solution for how the `n_genes_add` `bled_codes` indicated by `genes[s]`
-    can best explain `pixel_colors[:, s]` for each pixel s.
+    can best explain `pixel_colors[s]` for each pixel s.
 
     Args:
-        bled_codes: `float [(n_rounds x n_channels) x n_genes]`.
-            Flattened then transposed bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
-        pixel_colors: `float [(n_rounds x n_channels) x n_pixels]`.
-            Flattened then transposed `pixel_colors` which usually has the shape `[n_pixels x n_rounds x n_channels]`.
+        bled_codes: `float [n_genes x (n_rounds x n_channels)]`.
+            Flattened bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
+        pixel_colors: `float [n_pixels x (n_rounds x n_channels)]`.
+            Flattened `pixel_colors` which usually has the shape `[n_pixels x n_rounds x n_channels]`.
         genes: `int [n_pixels x n_genes_add]`.
             Indices of codes in bled_codes to find coefficients for which best explain each pixel_color.
 
@@ -55,7 +57,7 @@ def fit_coefs(bled_codes: jnp.ndarray, pixel_colors: jnp.ndarray,
         - coefs - `float [n_pixels x n_genes_add]`.
             Coefficients found through least squares fitting for each gene.
     """
-    return jax.vmap(fit_coefs_single, in_axes=(None, 1, 0), out_axes=(0, 0))(bled_codes, pixel_colors, genes)
+    return jax.vmap(fit_coefs_single, in_axes=(None, 0, 0), out_axes=(0, 0))(bled_codes, pixel_colors, genes)
 
 
 def fit_coefs_weight_single(bled_codes: jnp.ndarray, pixel_color: jnp.ndarray, genes: jnp.ndarray,
@@ -66,8 +68,8 @@ def fit_coefs_weight_single(bled_codes: jnp.ndarray, pixel_color: jnp.ndarray, g
     the coefficients of each gene.
 
     Args:
-        bled_codes: `float [(n_rounds x n_channels) x n_genes]`.
-            Flattened then transposed bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
+        bled_codes: `float [n_genes x (n_rounds x n_channels)]`.
+            Flattened bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
         pixel_color: `float [(n_rounds x n_channels)]`.
             Flattened `pixel_color` which usually has the shape `[n_rounds x n_channels]`.
         genes: `int [n_genes_add]`.
@@ -82,8 +84,9 @@ def fit_coefs_weight_single(bled_codes: jnp.ndarray, pixel_color: jnp.ndarray, g
         - coefs - `float [n_genes_add]`.
             Coefficients found through least squares fitting for each gene.
     """
-    coefs = jnp.linalg.lstsq(bled_codes[:, genes] * weight[:, jnp.newaxis], pixel_color * weight)[0]
-    residual = pixel_color * weight - jnp.matmul(bled_codes[:, genes] * weight[:, jnp.newaxis], coefs)
+    codes_weight = bled_codes[genes].transpose() * weight[:, jnp.newaxis]
+    coefs = jnp.linalg.lstsq(codes_weight, pixel_color * weight)[0]
+    residual = pixel_color * weight - jnp.matmul(codes_weight, coefs)
     return residual / weight, coefs
 
 
@@ -92,14 +95,14 @@ def fit_coefs_weight(bled_codes: jnp.ndarray, pixel_colors: jnp.ndarray, genes:
                      weight: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
     """
     This finds the weighted least squared solution for how the `n_genes_add` `bled_codes` indicated by `genes[s]`
-    can best explain `pixel_colors[:, s]` for each pixel s. The `weight` indicates which rounds/channels should
+    can best explain `pixel_colors[s]` for each pixel s. The `weight` indicates which rounds/channels should
     have more influence when finding the coefficients of each gene.
 
     Args:
-        bled_codes: `float [(n_rounds x n_channels) x n_genes]`.
-            Flattened then transposed bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
-        pixel_colors: `float [(n_rounds x n_channels) x n_pixels]`.
-            Flattened then transposed `pixel_colors` which usually has the shape `[n_pixels x n_rounds x n_channels]`.
+        bled_codes: `float [n_genes x (n_rounds x n_channels)]`.
+            Flattened bled codes which usually has the shape `[n_genes x n_rounds x n_channels]`.
+        pixel_colors: `float [n_pixels x (n_rounds x n_channels)]`.
+            Flattened `pixel_colors` which usually has the shape `[n_pixels x n_rounds x n_channels]`.
         genes: `int [n_pixels x n_genes_add]`.
             Indices of codes in bled_codes to find coefficients for which best explain each pixel_color.
         weight: `float [n_pixels x (n_rounds x n_channels)]`.
@@ -112,7 +115,7 @@ def fit_coefs_weight(bled_codes: jnp.ndarray, pixel_colors: jnp.ndarray, genes:
         - coefs - `float [n_pixels x n_genes_add]`.
             Coefficients found through least squares fitting for each gene.
     """
-    return jax.vmap(fit_coefs_weight_single, in_axes=(None, 1, 0, 0), out_axes=(0, 0))(bled_codes, pixel_colors, genes,
+    return jax.vmap(fit_coefs_weight_single, in_axes=(None, 0, 0, 0), out_axes=(0, 0))(bled_codes, pixel_colors, genes,
                                                                                        weight)
 
 
@@ -409,10 +412,11 @@ def get_all_coefs(pixel_colors: jnp.ndarray, bled_codes: jnp.ndarray, background
     # uses residual color as used to find next gene to add.
     bled_codes = bled_codes.reshape((n_genes, -1))
     all_codes = jnp.concatenate((bled_codes, background_codes.reshape(n_channels, -1)))
-    bled_codes = bled_codes.transpose()
 
     # colors and codes for fit_coefs function (No background as this is not updated again).
     # always uses post background color as coefficients for all genes re-estimated at each iteration.
+    # Both are kept with one row per gene/pixel, as jax arrays are row major, so transposing would copy every pixel
+    # and each selection of genes/pixels would gather strided columns.
     pixel_colors = pixel_colors.reshape((n_pixels, -1))
 
     continue_pixels = jnp.arange(n_pixels)
@@ -425,7 +429,6 @@ def get_all_coefs(pixel_colors: jnp.ndarray, bled_codes: jnp.ndarray, background
                     get_best_gene_first_iter(pixel_colors, all_codes, background_coefs, dp_shift,
                                              dp_thresh, alpha, beta, background_genes)
                 inverse_var = 1 / background_variance
-                pixel_colors = pixel_colors.transpose()
             else:
                 # only continue with pixels for which dot product score exceeds threshold
                 i_added_genes, pass_score_thresh, inverse_var = \
@@ -440,14 +443,16 @@ def get_all_coefs(pixel_colors: jnp.ndarray, bled_codes: jnp.ndarray, background
 
             continue_pixels = continue_pixels[pass_score_thresh]
             n_continue = jnp.size(continue_pixels)
-            pbar.set_postfix({'n_pixels': n_continue})
+            if not no_verbose:
+                # Only format the postfix when the progress bar is shown, as formatting the jax n_continue waits for the device
+                pbar.set_postfix({'n_pixels': n_continue})
             if n_continue == 0:
                 break
             if i == 0:
                 added_genes = added_genes[pass_score_thresh, np.newaxis]
             else:
                 added_genes = jnp.hstack((added_genes[pass_score_thresh], i_added_genes[pass_score_thresh, jnp.newaxis]))
-            pixel_colors = pixel_colors[:, pass_score_thresh]
+            pixel_colors = pixel_colors[pass_score_thresh]
             background_variance = background_variance[pass_score_thresh]
             inverse_var = inverse_var[pass_score_thresh]
 
@@ -463,6 +468,5 @@ def get_all_coefs(pixel_colors: jnp.ndarray, bled_codes: jnp.ndarray, background
                 gene_coefs[np.asarray(continue_pixels)[:, np.newaxis], np.asarray(added_genes)] = np.asarray(i_coefs)
 
             pbar.update(1)
-    pbar.close()
 
     return gene_coefs.astype(np.float32), np.asarray(background_coefs).astype(np.float32)
\ No newline at end of file
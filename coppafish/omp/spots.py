@@ -4,7 +4,7 @@ import numpy as np
 from .. import utils
 from ..utils.spot_images import get_spot_images, get_average_spot_image
 from ..find_spots import detect_spots, get_isolated_points
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, csc_matrix, issparse
 from tqdm import tqdm
 import numpy_indexed
 
@@ -43,10 +43,13 @@ def count_spot_neighbours(image: np.ndarray, spot_yxz: np.ndarray,
         # Image 2D but pos_filter 3D
         kernel = np.mean(kernel, axis=kernel.ndim - 1)
 
-    # Check kernel contains right values.
-    kernel_vals = np.unique(kernel)
-    if not np.isin(kernel_vals, [-1, 0, 1]).all():
+    # Check kernel contains right values. Equality checks on the small kernel avoid np.unique and np.isin which are
+    # comparatively slow, as this is called once for every gene in get_spots.
+    kernel_pos = kernel == 1
+    kernel_neg = kernel == -1
+    if not (kernel_pos | kernel_neg | (kernel == 0)).all():
         raise ValueError('filter contains values other than -1, 0 or 1.')
+    has_pos, has_neg = kernel_pos.any(), kernel_neg.any()
 
     # Check all spots in image
     max_yxz = np.array(image.shape) - 1
@@ -54,23 +57,23 @@ def count_spot_neighbours(image: np.ndarray, spot_yxz: np.ndarray,
     if len(spot_oob) > 0:
         raise utils.errors.OutOfBoundsError("spot_yxz", spot_oob[0], [0] * image.ndim, max_yxz)
 
-    if np.isin([-1, 1], kernel_vals).all():
+    if has_pos and has_neg:
         # Return positive and negative counts
-        n_pos = utils.morphology.imfilter_coords(image > 0, kernel > 0, spot_yxz)
-        n_neg = utils.morphology.imfilter_coords(image < 0, kernel < 0, spot_yxz)
+        n_pos = utils.morphology.imfilter_coords(image > 0, kernel_pos, spot_yxz)
+        n_neg = utils.morphology.imfilter_coords(image < 0, kernel_neg, spot_yxz)
         return n_pos, n_neg
-    elif np.isin(-1, kernel_vals):
+    elif has_neg:
         # Return negative counts
-        return utils.morphology.imfilter_coords(image < 0, kernel < 0, spot_yxz).astype(int)
-    elif np.isin(1, kernel_vals):
+        return utils.morphology.imfilter_coords(image < 0, kernel_neg, spot_yxz).astype(int)
+    elif has_pos:
         # Return positive counts
-        return utils.morphology.imfilter_coords(image > 0, kernel > 0, spot_yxz).astype(int)
+        return utils.morphology.imfilter_coords(image > 0, kernel_pos, spot_yxz).astype(int)
     else:
         raise ValueError('filter contains only 0.')
 
 
-def cropped_coef_image(pixel_yxz: np.ndarray,
-                       pixel_coefs: Union[csr_matrix, np.array]) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+def cropped_coef_image(pixel_yxz: np.ndarray, pixel_coefs: Union[csr_matrix, csc_matrix, np.array]
+                       ) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
     """
     Make cropped coef_image which is smallest possible image such that all non-zero pixel_coefs included.
 
@@ -90,9 +93,12 @@ def cropped_coef_image(pixel_yxz: np.ndarray,
             yxz shift subtracted from pixel_yxz to build coef_image.
             Will be `None` if there are no non-zero coefficients.
     """
-    if isinstance(pixel_coefs, csr_matrix):
-        nz_ind = pixel_coefs.nonzero()[0]
-        nz_pixel_coefs = pixel_coefs[nz_ind].toarray().flatten()
+    if issparse(pixel_coefs):
+        # Read the stored values directly, rather than indexing the sparse matrix again with its non-zero rows
+        pixel_coefs = pixel_coefs.tocoo()
+        nz = pixel_coefs.data != 0
+        nz_ind = pixel_coefs.row[nz]
+        nz_pixel_coefs = pixel_coefs.data[nz]
     else:
         nz_ind = pixel_coefs != 0
         nz_pixel_coefs = pixel_coefs[nz_ind]
@@ -163,6 +169,9 @@ def spot_neighbourhood(pixel_coefs: Union[csr_matrix, np.array], pixel_yxz: np.n
     if not utils.errors.check_shape(pixel_yxz, [n_pixels, 3]):
         raise utils.errors.ShapeError('pixel_yxz', pixel_yxz.shape,
                                       (n_pixels, 3))
+    if issparse(pixel_coefs):
+        # Coefficients are read one gene at a time, and slicing a column from csc form only touches that column.
+        pixel_coefs = pixel_coefs.tocsc()
     n_spots = spot_gene_no.shape[0]
     if not utils.errors.check_shape(spot_yxz, [n_spots, 3]):
         raise utils.errors.ShapeError('spot_yxz', spot_yxz.shape,
@@ -184,6 +193,9 @@ def spot_neighbourhood(pixel_coefs: Union[csr_matrix, np.array], pixel_yxz: np.n
         mid_yx = np.floor(pos_filter_shape_yx/2).astype(int)
         pos_filter[mid_yx, mid_yx, 0] = 1
         pos_filter[mid_yx, mid_yx, 2] = 1
+    # yxz shift from each spot of every pixel in its pos_filter neighbourhood, so the positive pixels about each spot can
+    # be counted by indexing the coefficient image at just these, rather than thresholding the whole image.
+    pos_filter_shifts = np.argwhere(pos_filter) - (np.array(pos_filter.shape) - 1) // 2
 
     max_size = np.array(max_size)
     if n_z == 1:
@@ -193,32 +205,37 @@ def spot_neighbourhood(pixel_coefs: Union[csr_matrix, np.array], pixel_yxz: np.n
         max_size[max_size_odd_loc] += 1  # ensure shape is odd
 
     # get image centred on each spot.
-    # Big image shape which will be cropped later.
-    spot_images = np.zeros((0, *max_size), dtype=int)
+    # Big image shape which will be cropped later. Only contains -1, 0 or 1 so int8 is used to reduce memory.
+    spot_images = np.zeros((0, *max_size), dtype=np.int8)
     spots_used = np.zeros(n_spots, dtype=bool)
     for g in range(n_genes):
         use = spot_gene_no == g
         if use.any():
             # Note size of image will be different for each gene.
-            coef_sign_image, coord_shift = cropped_coef_image(pixel_yxz, pixel_coefs[:, g])
-            if coef_sign_image is None:
+            coef_image, coord_shift = cropped_coef_image(pixel_yxz, pixel_coefs[:, g])
+            if coef_image is None:
                 # Go to next gene if no non-zero coefficients for this gene
                 continue
-            coef_sign_image = np.sign(coef_sign_image).astype(int)
+            if coef_image.ndim == 2:
+                coef_image = coef_image[:, :, np.newaxis]
             g_spot_yxz = spot_yxz[use] - coord_shift
 
             # Only keep spots with all neighbourhood having positive coefficient.
-            n_pos_neighb = count_spot_neighbours(coef_sign_image, g_spot_yxz, pos_filter)
-            g_use = n_pos_neighb == pos_filter.sum()
+            # Neighbourhood pixels outside coef_image have zero coefficient, as it is cropped to the non-zero coefs.
+            neighb_yxz = g_spot_yxz[:, np.newaxis] + pos_filter_shifts
+            in_image = np.logical_and(neighb_yxz >= 0, neighb_yxz < coef_image.shape).all(axis=2)
+            neighb_yxz = np.clip(neighb_yxz, 0, np.array(coef_image.shape) - 1)
+            neighb_pos = coef_image[neighb_yxz[:, :, 0], neighb_yxz[:, :, 1], neighb_yxz[:, :, 2]] > 0
+            g_use = np.logical_and(neighb_pos, in_image).all(axis=1)
             use[np.where(use)[0][np.invert(g_use)]] = False
-            if coef_sign_image.ndim == 2:
-                coef_sign_image = coef_sign_image[:, :, np.newaxis]
             if use.any():
-                # nan_to_num sets nan to zero i.e. if out of range of coef_sign_image, coef assumed zero.
-                # This is what we want as have cropped coef_sign_image to exclude zero coefficients.
+                # Only the signs of the coefficients about the spots used are needed, so take the sign of these small
+                # images rather than of the whole coef_image.
+                # nan_to_num sets nan to zero i.e. if out of range of coef_image, coef assumed zero.
+                # This is what we want as have cropped coef_image to exclude zero coefficients.
                 spot_images = np.append(
-                    spot_images, np.nan_to_num(get_spot_images(coef_sign_image, g_spot_yxz[g_use], max_size)
-                                               ).astype(int), axis=0)
+                    spot_images, np.nan_to_num(np.sign(get_spot_images(coef_image, g_spot_yxz[g_use], max_size))
+                                               ).astype(np.int8), axis=0)
                 spots_used[use] = True
 
     if not spots_used.any():
@@ -319,6 +336,9 @@ def get_spots(pixel_coefs: Union[csr_matrix, np.array], pixel_yxz: np.ndarray, r
             raise utils.errors.OutOfBoundsError("pos_neighbour_thresh", pos_neighbour_thresh, 0,
                                                 np.sum(spot_shape > 0)-1)
         spot_info = np.zeros((0, 6), dtype=int)
+    if issparse(pixel_coefs):
+        # Coefficients are read one gene at a time, and slicing a column from csc form only touches that column.
+        pixel_coefs = pixel_coefs.tocsc()
 
     if spot_yxzg is not None:
         # check pixel coefficient is positive for random subset of 500 spots.
@@ -0,0 +1,74 @@
+from coppafish.omp.coefs import fit_coefs, fit_coefs_weight
+
+import numpy as np
+
+
+def test_fit_coefs():
+    rng = np.random.RandomState(0)
+    n_pixels, n_genes, n_rounds_channels, n_genes_add = 50, 6, 12, 3
+    bled_codes = rng.rand(n_rounds_channels, n_genes)
+    pixel_colors = rng.rand(n_rounds_channels, n_pixels)
+    # Few distinct sets of genes, added in different orders, so pixels are fit in groups
+    genes = np.array([rng.permutation(gene_set) for gene_set in
+                      [[0, 1, 2], [3, 4, 5], [1, 2, 5]] * (n_pixels // 3 + 1)])[:n_pixels]
+    assert genes.shape == (n_pixels, n_genes_add)
+    residual, coefs = fit_coefs(bled_codes, pixel_colors, genes)
+    assert residual.shape == (n_pixels, n_rounds_channels)
+    assert coefs.shape == (n_pixels, n_genes_add)
+    for s in range(n_pixels):
+        coefs_s = np.linalg.lstsq(bled_codes[:, genes[s]], pixel_colors[:, s], rcond=None)[0]
+        assert np.allclose(coefs[s], coefs_s)
+        assert np.allclose(residual[s], pixel_colors[:, s] - bled_codes[:, genes[s]] @ coefs_s)
+
+
+def test_fit_coefs_collinear():
+    # Two nearly collinear codes, e.g. a gene code close to a background code. The float32 gram matrix is still
+    # positive definite, but too badly conditioned for the normal equations to give the least squares solution.
+    rng = np.random.RandomState(2)
+    n_pixels, n_rounds_channels = 10, 12
+    code = rng.rand(n_rounds_channels)
+    bled_codes = np.array([code, code + 1e-3 * rng.rand(n_rounds_channels), rng.rand(n_rounds_channels)],
+                          dtype=np.float32).T
+    pixel_colors = (bled_codes[:, :2] @ rng.rand(2, n_pixels)).astype(np.float32)
+    genes = np.tile([0, 1], (n_pixels, 1))
+    residual, coefs = fit_coefs(bled_codes, pixel_colors, genes)
+    for s in range(n_pixels):
+        coefs_s = np.linalg.lstsq(bled_codes[:, genes[s]].astype(float), pixel_colors[:, s].astype(float),
+                                  rcond=None)[0]
+        assert np.allclose(coefs[s], coefs_s, rtol=1e-2, atol=1e-2)
+        assert np.allclose(residual[s], pixel_colors[:, s] - bled_codes[:, genes[s]] @ coefs_s, atol=1e-4)
+
+
+def test_fit_coefs_weight_collinear():
+    # Same as test_fit_coefs_collinear but with a different weight for each pixel, so each pixel is fit separately.
+    rng = np.random.RandomState(3)
+    n_pixels, n_rounds_channels = 10, 12
+    code = rng.rand(n_rounds_channels)
+    bled_codes = np.array([code, code + 1e-3 * rng.rand(n_rounds_channels), rng.rand(n_rounds_channels)],
+                          dtype=np.float32).T
+    pixel_colors = (bled_codes[:, :2] @ rng.rand(2, n_pixels)).astype(np.float32)
+    genes = np.tile([0, 1], (n_pixels, 1))
+    weight = (rng.rand(n_pixels, n_rounds_channels) + 0.5).astype(np.float32)
+    residual, coefs = fit_coefs_weight(bled_codes, pixel_colors, genes, weight)
+    for s in range(n_pixels):
+        bled_codes_s = bled_codes[:, genes[s]].astype(float) * weight[s][:, np.newaxis]
+        coefs_s = np.linalg.lstsq(bled_codes_s, pixel_colors[:, s] * weight[s].astype(float), rcond=None)[0]
+        assert np.allclose(coefs[s], coefs_s, rtol=1e-2, atol=1e-2)
+        assert np.allclose(residual[s], pixel_colors[:, s] - bled_codes[:, genes[s]] @ coefs_s, atol=1e-4)
+
+
+def test_fit_coefs_weight():
+    rng = np.random.RandomState(1)
+    n_pixels, n_genes, n_rounds_channels, n_genes_add = 20, 6, 12, 2
+    bled_codes = rng.rand(n_rounds_channels, n_genes)
+    pixel_colors = rng.rand(n_rounds_channels, n_pixels)
+    genes = np.array([rng.choice(n_genes, n_genes_add, replace=False) for _ in range(n_pixels)])
+    weight = rng.rand(n_pixels, n_rounds_channels) + 0.1
+    residual, coefs = fit_coefs_weight(bled_codes, pixel_colors, genes, weight)
+    assert residual.shape == (n_pixels, n_rounds_channels)
+    assert coefs.shape == (n_pixels, n_genes_add)
+    for s in range(n_pixels):
+        bled_codes_s = bled_codes[:, genes[s]] * weight[s][:, np.newaxis]
+        coefs_s = np.linalg.lstsq(bled_codes_s, pixel_colors[:, s] * weight[s], rcond=None)[0]
+        assert np.allclose(coefs[s], coefs_s)
+        assert np.allclose(residual[s], pixel_colors[:, s] - bled_codes[:, genes[s]] @ coefs_s)
@@ -122,11 +122,8 @@ def call_reference_spots(config: dict, nbp_file: NotebookPage, nbp_basic: Notebo
                                 142, 142, 153, 100, 55738, 183, 168, 100, 99,
                                 366, 245, 100, 100, 101, 882, 100, 100, 99,
                                 2219])}
-        # initial_bleed_matrix is n_channels x n_dyes
-        initial_bleed_matrix = np.zeros((len(nbp_basic.use_channels), len(nbp_basic.dye_names)))
-        # Populate initial_bleed_matrix with dye info for all channels in use
-        for i, dye in enumerate(nbp_basic.dye_names):
-            initial_bleed_matrix[:, i] = dye_info[dye][use_channels]
+        # initial_bleed_matrix is n_channels x n_dyes, populated with dye info for all channels in use
+        initial_bleed_matrix = np.array([dye_info[dye][use_channels] for dye in nbp_basic.dye_names], dtype=float).T
     if nbp_file.initial_bleed_matrix is not None:
         # Use an initial bleed matrix given by the user
         initial_bleed_matrix = np.load(nbp_file.initial_bleed_matrix)
@@ -136,9 +133,8 @@ def call_reference_spots(config: dict, nbp_file: NotebookPage, nbp_basic: Notebo
                 f'expected {expected_shape}.'
     # normalise bleed matrix across channels, then once again across dyes so each column has norm 1
     bleed_norm = np.median(colour_norm_factor, axis=0)
-    # Want to divide each row by bleed_norm, so reshape bleed_norm to be n_channels x n_rounds
-    bleed_norm = np.repeat(bleed_norm[:, np.newaxis], n_rounds, axis=1)
-    initial_bleed_matrix = initial_bleed_matrix / bleed_norm
+    # Want to divide each row by bleed_norm, so broadcast bleed_norm along the dye axis
+    initial_bleed_matrix = initial_bleed_matrix / bleed_norm[:, np.newaxis]
     # now normalise each column (dye) to have norm 1
     bleed_matrix = initial_bleed_matrix / np.linalg.norm(initial_bleed_matrix, axis=0)
     # Repeat bleed n_rounds times along a new 0th axis
@@ -1,6 +1,8 @@
 from .. import utils
 from .. import find_spots as fs
 from tqdm import tqdm
+from joblib import Parallel, delayed
+from typing import Optional, Tuple
 import numpy as np
 import itertools
 from ..setup.notebook import NotebookPage
@@ -40,8 +42,7 @@ def find_spots(config: dict, nbp_file: NotebookPage, nbp_basic: NotebookPage, au
         nbp.isolation_thresh = auto_thresh[:, nbp_basic.anchor_round, nbp_basic.anchor_channel] * \
                                   config['auto_isolation_thresh_multiplier']
     else:
-        nbp.isolation_thresh = np.ones_like(auto_thresh[:, nbp_basic.anchor_round, nbp_basic.anchor_channel]) * \
-                                  config['isolation_thresh']
+        nbp.isolation_thresh = np.full(nbp_basic.n_tiles, config['isolation_thresh'], dtype=float)
     use_tiles, use_rounds, use_channels = nbp_basic.use_tiles, nbp_basic.use_rounds, nbp_basic.use_channels
 
     # Phase 1: Load in previous results if they exist
@@ -59,44 +60,42 @@ def find_spots(config: dict, nbp_file: NotebookPage, nbp_basic: NotebookPage, au
 
     uncompleted = np.logical_and(use_indices, np.logical_not(spot_info['completed']))
     n_z = np.max([1, nbp_basic.is_3d * nbp_basic.nz])
+    # Images are loaded with apply_shift=False, so need to shift the detect_spots thresh correspondingly.
+    # Do this for all tiles, rounds and channels at once rather than once per image.
+    detect_thresh = auto_thresh + nbp_basic.tile_pixel_value_shift
 
     # Phase 2: Detect spots on uncompleted tiles, rounds and channels
     with tqdm(total=np.sum(uncompleted)) as pbar:
         pbar.set_description(f"Detecting spots on filtered images saved as npy")
-        # Loop over uncompleted tiles, rounds and channels
-        for t, r, c in np.argwhere(uncompleted):
-            pbar.set_postfix({'tile': t, 'round': r, 'channel': c})
-            # Then need to shift the detect_spots and check_neighb_intensity thresh correspondingly.
-            image = utils.npy.load_tile(nbp_file, nbp_basic, t, r, c, apply_shift=False, 
-                                        suffix='_raw' if r == nbp_basic.pre_seq_round else '')
-            local_yxz, spot_intensity = fs.detect_spots(image,
-                                                       auto_thresh[t, r, c] + nbp_basic.tile_pixel_value_shift,
-                                                       config['radius_xy'], config['radius_z'], True)
-            no_negative_neighbour = fs.check_neighbour_intensity(image, local_yxz,
-                                                                 thresh=nbp_basic.tile_pixel_value_shift)
-            local_yxz = local_yxz[no_negative_neighbour]
-            spot_intensity = spot_intensity[no_negative_neighbour]
-            # If r is a reference round, we also get info about whether the spots are isolated
-            if r == nbp_basic.anchor_round:
-                isolated_spots = fs.get_isolated(image.astype(np.int32) - nbp_basic.tile_pixel_value_shift,
-                                                 local_yxz, nbp.isolation_thresh[t],
-                                                 config['isolation_radius_inner'],
-                                                 config['isolation_radius_xy'],
-                                                 config['isolation_radius_z'])
-                spot_info['isolated'] = np.append(spot_info['isolated'], isolated_spots)
-            else:
-                # if imaging round, only keep the highest intensity spots on each z plane
-                local_yxz = fs.filter_intense_spots(local_yxz, spot_intensity, n_z, max_spots)
-
+        # Loop over uncompleted tiles. Each round and channel of a tile is independent, so they are run in parallel
+        # threads, the heavy lifting (loading, jax and scipy) does not hold the GIL.
+        for t in np.where(uncompleted.any(axis=(1, 2)))[0]:
+            pbar.set_postfix({'tile': t})
+            trc_uncompleted = [(t, r, c) for r, c in np.argwhere(uncompleted[t])]
+            trc_spots = Parallel(n_jobs=config['n_jobs'], prefer='threads')(
+                delayed(find_spots_trc)(config, nbp_file, nbp_basic, t, r, c, detect_thresh[t, r, c],
+                                        nbp.isolation_thresh[t], n_z, max_spots) for t, r, c in trc_uncompleted)
+            # Results are returned in the same order as trc_uncompleted. They are gathered into lists and added to
+            # spot_info with one concatenate per tile, rather than copying all previous spots for every round and
+            # channel.
+            tile_spot_yxz, tile_isolated = [spot_info['spot_yxz']], [spot_info['isolated']]
+            for (t, r, c), (local_yxz, isolated_spots) in zip(trc_uncompleted, trc_spots):
+                # isolated_spots is only found for the anchor round
+                if isolated_spots is not None:
+                    tile_isolated.append(isolated_spots)
+                tile_spot_yxz.append(local_yxz)
+                spot_info['spot_no'][t, r, c] = local_yxz.shape[0]
+                spot_info['completed'][t, r, c] = True
+                pbar.update(1)
             # Save results to spot_info
-            spot_info['spot_yxz'] = np.vstack((spot_info['spot_yxz'], local_yxz))
-            spot_info['spot_no'][t, r, c] = local_yxz.shape[0]
-            spot_info['completed'][t, r, c] = True
+            spot_info['spot_yxz'] = np.concatenate(tile_spot_yxz, axis=0)
+            spot_info['isolated'] = np.concatenate(tile_isolated)
             assert spot_info['spot_yxz'].shape[0] == np.sum(spot_info['spot_no']), \
-                "spot_yxz and spot_no do not match. Tile {}, round {}, channel {}".format(t, r, c)
+                "spot_yxz and spot_no do not match. Tile {}".format(t)
+            # Only save spot_info to file once all rounds and channels of the tile are done, rewriting the whole file
+            # after every round and channel takes a long time once many spots have been found.
             np.savez(nbp_file.spot_details_info, spot_info['spot_yxz'], spot_info['spot_no'], spot_info['isolated'],
                      spot_info['completed'])
-            pbar.update(1)
 
     # Phase 3: Save results to notebook page
     nbp.spot_yxz = spot_info['spot_yxz']
@@ -104,3 +103,54 @@ def find_spots(config: dict, nbp_file: NotebookPage, nbp_basic: NotebookPage, au
     nbp.isolated_spots = spot_info['isolated']
 
     return nbp
+
+
+def find_spots_trc(config: dict, nbp_file: NotebookPage, nbp_basic: NotebookPage, t: int, r: int, c: int,
+                   detect_thresh: float, isolation_thresh: float, n_z: int,
+                   max_spots: int) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Finds the spots on a single tile, round and channel.
+
+    Args:
+        config: Dictionary obtained from `'find_spots'` section of config file.
+        nbp_file: `file_names` notebook page
+        nbp_basic: `basic_info` notebook page
+        t: Tile considering.
+        r: Round considering.
+        c: Channel considering.
+        detect_thresh: Local maxima with pixel values greater than this are considered spots.
+            As the image is loaded without removing `nbp_basic.tile_pixel_value_shift`, this should be
+            `auto_thresh[t, r, c] + nbp_basic.tile_pixel_value_shift`.
+        isolation_thresh: Spots are isolated if annulus filtered image at spot location less than this.
+            Only used if `r` is the anchor round.
+        n_z: Number of z planes.
+        max_spots: Maximum number of spots kept on each z plane of an imaging round.
+
+    Returns:
+        - `local_yxz` - `int [n_spots x 3]`.
+            yxz coordinates of the spots found.
+        - `isolated_spots` - `bool [n_spots]`.
+            Whether each spot is isolated, `None` if `r` is not the anchor round.
+    """
+    # Then need to shift the check_neighb_intensity thresh correspondingly.
+    pixel_value_shift = nbp_basic.tile_pixel_value_shift
+    image = utils.npy.load_tile(nbp_file, nbp_basic, t, r, c, apply_shift=False,
+                                suffix='_raw' if r == nbp_basic.pre_seq_round else '')
+    # Spots with a negative (after removing the shift) neighbour are removed while the local maxima are found
+    local_yxz, spot_intensity = fs.detect_spots(image, detect_thresh, config['radius_xy'], config['radius_z'], True,
+                                                neighbour_thresh=pixel_value_shift)
+    # If r is a reference round, we also get info about whether the spots are isolated
+    isolated_spots = None
+    if r == nbp_basic.anchor_round:
+        isolated_spots = fs.get_isolated(image, local_yxz, isolation_thresh, config['isolation_radius_inner'],
+                                         config['isolation_radius_xy'], config['isolation_radius_z'],
+                                         image_shift=pixel_value_shift)
+    else:
+        # if imaging round, only keep the highest intensity spots on each z plane
+        local_yxz = fs.filter_intense_spots(local_yxz, spot_intensity, n_z, max_spots)
+    # Store spots in Morton order, so spots close in space are close in memory for the KDTree queries in register
+    order = fs.morton_order(local_yxz)
+    local_yxz = local_yxz[order]
+    if isolated_spots is not None:
+        isolated_spots = isolated_spots[order]
+    return local_yxz, isolated_spots
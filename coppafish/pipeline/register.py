@@ -1,18 +1,17 @@
-import os
-import pickle
 import itertools
 import numpy as np
 from tqdm import tqdm
-from scipy.ndimage import affine_transform
+from joblib import Parallel, delayed
+from scipy.ndimage import gaussian_filter
 from skimage.registration import phase_cross_correlation
-from skimage.filters import gaussian
 from .. import utils
 from ..setup import NotebookPage
 from ..utils.npy import load_tile
 from ..find_spots import spot_yxz
-from ..register.base import icp, regularise_transforms, round_registration, channel_registration, brightness_scale
-from ..register.preprocessing import compose_affine, invert_affine, zyx_to_yxz_affine, yxz_to_zyx_affine, \
-    load_reg_data, yxz_to_zyx
+from ..register.base import icp, regularise_transforms, round_registration, channel_registration, brightness_scale, \
+    affine_transform_image
+from ..register.preprocessing import invert_affine, yxz_to_zyx_affine, \
+    load_reg_data, save_reg_data, save_reg_data_tile, yxz_to_zyx, voxel_downsample
 
 
 def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: NotebookPage,
@@ -88,6 +87,7 @@ def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: Noteb
     # round registration
     with tqdm(total=len(uncompleted_tiles)) as pbar:
         pbar.set_description(f"Running initial round registration on all tiles")
+        round_buffer = None
         for t in uncompleted_tiles:
             # Load in the anchor image and the round images. Note that here anchor means anchor round, not necessarily
             # anchor channel
@@ -96,10 +96,15 @@ def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: Noteb
             use_rounds = nbp_basic.use_rounds + [nbp_basic.pre_seq_round] * nbp_basic.use_preseq
             # split the rounds into two chunks, as we can't fit all of them into memory at once
             round_chunks = [use_rounds[:len(use_rounds) // 2], use_rounds[len(use_rounds) // 2:]]
+            if round_buffer is None:
+                # One zyx buffer big enough for the larger chunk, shared between both chunks and all tiles
+                round_buffer = np.zeros((len(round_chunks[1]),) + anchor_image.shape, dtype=np.int32)
             for i in range(2):
-                round_image = [yxz_to_zyx(load_tile(nbp_file, nbp_basic, t=t, r=r, c=round_registration_channel,
-                                                    suffix='_raw' if r == nbp_basic.pre_seq_round else ''))
-                               for r in round_chunks[i]]
+                round_image = [round_buffer[j] for j in range(len(round_chunks[i]))]
+                for j, r in enumerate(round_chunks[i]):
+                    load_tile(nbp_file, nbp_basic, t=t, r=r, c=round_registration_channel,
+                              suffix='_raw' if r == nbp_basic.pre_seq_round else '',
+                              out=np.moveaxis(round_image[j], 0, 2))
                 round_reg_data = round_registration(anchor_image=anchor_image, round_image=round_image, config=config)
                 # Now save the data
                 registration_data['round_registration']['transform_raw'][t, round_chunks[i]] = round_reg_data['transform']
@@ -109,9 +114,8 @@ def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: Noteb
             # Now append anchor info and tile number to the registration data, then save to file
             registration_data['round_registration']['transform'][t, nbp_basic.anchor_round] = np.eye(3, 4)
             registration_data['round_registration']['tiles_completed'].append(t)
-            # Save the data to file
-            with open(os.path.join(nbp_file.output_dir, 'registration_data.pkl'), 'wb') as f:
-                pickle.dump(registration_data, f)
+            # Save the data of this tile to file
+            save_reg_data_tile(nbp_file, registration_data, t)
             pbar.update(1)
 
     # Part 2: Regularisation
@@ -122,16 +126,23 @@ def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: Noteb
                                               use_rounds=nbp_basic.use_rounds +
                                                          [nbp_basic.pre_seq_round] * nbp_basic.use_preseq)
 
-    # Now combine all of these into single sub-vol transform array via composition
-    for t in use_tiles:
-        for r in use_rounds + [nbp_basic.pre_seq_round] * nbp_basic.use_preseq:
-            for c in use_channels:
-                registration_data['initial_transform'][t, r, c] = \
-                    zyx_to_yxz_affine(compose_affine(registration_data['channel_registration']['transform'][c],
-                                                     registration_data['round_registration']['transform'][t, r]))
+    # Now combine all of these into single sub-vol transform array via composition. This is done for all tiles, rounds
+    # and channels at once, channel_transform[c] @ round_transform[t, r] in homogeneous coordinates
+    compose_rounds = use_rounds + [nbp_basic.pre_seq_round] * nbp_basic.use_preseq
+    channel_transform = registration_data['channel_registration']['transform'][use_channels]
+    round_transform = registration_data['round_registration']['transform'][np.ix_(use_tiles, compose_rounds)]
+    composed_transform = np.zeros((len(use_tiles), len(compose_rounds), len(use_channels), 3, 4))
+    composed_transform[..., :3] = np.einsum('cij,trjk->trcik', channel_transform[:, :, :3], round_transform[..., :3])
+    composed_transform[..., 3] = np.einsum('cij,trj->trci', channel_transform[:, :, :3], round_transform[..., 3]) \
+        + channel_transform[:, :, 3]
+    # Convert from zyx to yxz coordinates (equivalent to zyx_to_yxz_affine) by permuting the axes and transposing
+    yxz = [1, 2, 0]
+    initial_transform = np.zeros(composed_transform.shape[:3] + (4, 3))
+    initial_transform[..., :3, :] = np.swapaxes(composed_transform[..., yxz, :][..., yxz], -1, -2)
+    initial_transform[..., 3, :] = composed_transform[..., yxz, 3]
+    registration_data['initial_transform'][np.ix_(use_tiles, compose_rounds, use_channels)] = initial_transform
     # Now save registration data externally
-    with open(os.path.join(nbp_file.output_dir, 'registration_data.pkl'), 'wb') as f:
-        pickle.dump(registration_data, f)
+    save_reg_data(nbp_file, registration_data)
 
     # Part 3: ICP
     if 'icp' not in registration_data.keys():
@@ -148,6 +159,8 @@ def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: Noteb
             for t in use_tiles:
                 ref_spots_t = spot_yxz(nbp_find_spots.spot_yxz, t, nbp_basic.anchor_round, nbp_basic.anchor_channel,
                                        nbp_find_spots.spot_no)
+                if config['icp_voxel_size'] is not None:
+                    ref_spots_t = voxel_downsample(ref_spots_t, config['icp_voxel_size'])
                 for r, c in itertools.product(use_rounds + [nbp_basic.pre_seq_round] * nbp_basic.use_preseq,
                                               use_channels):
                     pbar.set_postfix({"Tile": t, "Round": r, "Channel": c})
@@ -171,25 +184,24 @@ def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: Noteb
         registration_data['icp'] = {'transform': icp_transform, 'n_matches': n_matches, 'mse': mse,
                                     'converged': converged}
         # Save registration data externally
-        with open(os.path.join(nbp_file.output_dir, 'registration_data.pkl'), 'wb') as f:
-            pickle.dump(registration_data, f)
+        save_reg_data(nbp_file, registration_data)
 
     # Now blur the pre seq round images
     if registration_data['blur'] is False and nbp_basic.use_preseq:
-        for t, c in tqdm(itertools.product(use_tiles, use_channels + [nbp_basic.dapi_channel])):
-            print(f" Blurring pre-seq tile {t}, channel {c}")
-            # Load in the pre-seq round image, blur it and save it under a different name (dropping the _raw suffix)
-            im = load_tile(nbp_file, nbp_basic, t=t, r=nbp_basic.pre_seq_round, c=c, suffix='_raw')
-            if pre_seq_blur_radius > 0:
-                for z in tqdm(range(len(nbp_basic.use_z))):
-                    im[:, :, z] = gaussian(im[:, :, z], pre_seq_blur_radius, truncate=3, preserve_range=True)
-            # Save the blurred image (no need to rotate this, as the rotation was done in extract)
-            utils.npy.save_tile(nbp_file, nbp_basic, im, t, r, c)
+        # Each channel of a tile is independent, so they are loaded, blurred and saved in parallel threads. Loading,
+        # saving and gaussian_filter do not hold the GIL so the disk reads/writes overlap with the blurring.
+        with tqdm(total=len(use_tiles)) as pbar:
+            pbar.set_description(f"Blurring pre-seq tiles")
+            for t in use_tiles:
+                pbar.set_postfix({'tile': t})
+                Parallel(n_jobs=config['n_jobs'], prefer='threads')(
+                    delayed(blur_pre_seq_tile)(nbp_file, nbp_basic, t, c, pre_seq_blur_radius)
+                    for c in use_channels + [nbp_basic.dapi_channel])
+                pbar.update(1)
         registration_data['blur'] = True
 
     # Save registration data externally
-    with open(os.path.join(nbp_file.output_dir, 'registration_data.pkl'), 'wb') as f:
-        pickle.dump(registration_data, f)
+    save_reg_data(nbp_file, registration_data)
     # Add round statistics to debugging page.
     nbp_debug.position = registration_data['round_registration']['position']
     nbp_debug.round_shift = registration_data['round_registration']['shift']
@@ -223,19 +235,44 @@ def register(nbp_basic: NotebookPage, nbp_file: NotebookPage, nbp_extract: Noteb
         bg_scale = np.zeros((n_tiles, n_rounds, n_channels))
         mid_z = nbp_basic.tile_centre[2].astype(int)
         z_rad = np.min([len(nbp_basic.use_z) // 2, 5])
-        for t, r, c in tqdm(itertools.product(use_tiles, use_rounds, use_channels)):
-            print(f"Computing background scale for tile {t}, round {r}, channel {c}")
-            transform_pre = yxz_to_zyx_affine(nbp.transform[t, nbp_basic.pre_seq_round, c],
-                                              new_origin=np.array([mid_z-z_rad, 0, 0]))
-            transform_seq = yxz_to_zyx_affine(nbp.transform[t, r, c], new_origin=np.array([mid_z-z_rad, 0, 0]))
-            preseq = yxz_to_zyx(load_tile(nbp_file, nbp_basic, t=t, r=nbp_basic.pre_seq_round, c=c,
-                                          yxz=[None, None, np.arange(mid_z-z_rad, mid_z+z_rad)]))
-            seq = yxz_to_zyx(load_tile(nbp_file, nbp_basic, t=t, r=r, c=c,
-                                       yxz=[None, None, np.arange(mid_z-z_rad, mid_z+z_rad)]))
-            preseq = affine_transform(preseq, transform_pre)
-            seq = affine_transform(seq, transform_seq)
-            bg_scale[t, r, c] = brightness_scale(preseq, seq)[0]
+        with tqdm(total=len(use_tiles) * len(use_rounds) * len(use_channels)) as pbar:
+            pbar.set_description(f"Computing background scale")
+            for t, c in itertools.product(use_tiles, use_channels):
+                # The pre-seq image is the same for all rounds, so only load and transform it once
+                transform_pre = yxz_to_zyx_affine(nbp.transform[t, nbp_basic.pre_seq_round, c],
+                                                  new_origin=np.array([mid_z-z_rad, 0, 0]))
+                preseq = yxz_to_zyx(load_tile(nbp_file, nbp_basic, t=t, r=nbp_basic.pre_seq_round, c=c,
+                                              yxz=[None, None, np.arange(mid_z-z_rad, mid_z+z_rad)]))
+                preseq = affine_transform_image(preseq, transform_pre)
+                for r in use_rounds:
+                    pbar.set_postfix({"Tile": t, "Round": r, "Channel": c})
+                    transform_seq = yxz_to_zyx_affine(nbp.transform[t, r, c], new_origin=np.array([mid_z-z_rad, 0, 0]))
+                    seq = yxz_to_zyx(load_tile(nbp_file, nbp_basic, t=t, r=r, c=c,
+                                               yxz=[None, None, np.arange(mid_z-z_rad, mid_z+z_rad)]))
+                    seq = affine_transform_image(seq, transform_seq)
+                    bg_scale[t, r, c] = brightness_scale(preseq, seq)[0]
+                    pbar.update(1)
         nbp_extract.bg_scale = bg_scale
         nbp_extract.finalized = True
 
     return nbp, nbp_debug
+
+
+def blur_pre_seq_tile(nbp_file: NotebookPage, nbp_basic: NotebookPage, t: int, c: int, blur_radius: float):
+    """
+    Loads in the raw pre-seq round image of tile `t`, channel `c`, blurs it and saves it under the pre-seq round name
+    (dropping the _raw suffix).
+
+    Args:
+        nbp_file: `file_names` notebook page
+        nbp_basic: `basic_info` notebook page
+        t: Tile considering.
+        c: Channel considering.
+        blur_radius: Radius of gaussian blur applied to each z-plane. No blur is applied if this is 0.
+    """
+    im = load_tile(nbp_file, nbp_basic, t=t, r=nbp_basic.pre_seq_round, c=c, suffix='_raw')
+    if blur_radius > 0:
+        # Blur each z-plane separately (sigma=0 in z) in a single call, in place to save memory
+        gaussian_filter(im, sigma=(blur_radius, blur_radius, 0), truncate=3, mode='nearest', output=im)
+    # Save the blurred image (no need to rotate this, as the rotation was done in extract)
+    utils.npy.save_tile(nbp_file, nbp_basic, im, t, nbp_basic.pre_seq_round, c)
@@ -1,8 +1,11 @@
 from ..stitch import compute_shift, update_shifts, get_tile_origin, get_shifts_to_search
 from tqdm import tqdm
+from joblib import Parallel, delayed
+from typing import Tuple
 from ..find_spots import spot_yxz
 import numpy as np
 import warnings
+import os
 from ..setup.notebook import NotebookPage
 
 
@@ -38,85 +41,128 @@ def stitch(config: dict, nbp_basic: NotebookPage, local_yxz: np.ndarray, spot_no
         config['shift_max_range'][2] = 0
 
     # initialise variables to store shift info
+    # Shift info is collected in lists while looping over tiles and converted to arrays once after, as np.append copies
+    # the whole array for every tile. The good shifts are also collected, so they are not found again for each tile.
     shift_info = {'north': {}, 'east': {}}
+    good_shift_list = {'north': [], 'east': []}
     for j in directions:
-        shift_info[j]['pairs'] = np.zeros((0, 2), dtype=int)
-        shift_info[j]['shifts'] = np.zeros((0, 3), dtype=int)
-        shift_info[j]['score'] = np.zeros((0, 1), dtype=float)
-        shift_info[j]['score_thresh'] = np.zeros((0, 1), dtype=float)
+        shift_info[j]['pairs'] = [np.zeros((0, 2), dtype=int)]
+        shift_info[j]['shifts'] = [np.zeros((0, 3), dtype=int)]
+        shift_info[j]['score'] = [np.zeros((0, 1), dtype=float)]
+        shift_info[j]['score_thresh'] = [np.zeros((0, 1), dtype=float)]
 
     # find shifts between overlapping tiles
     c = nbp_basic.anchor_channel
     r = nbp_basic.anchor_round
-    t_neighb = {'north': [], 'east': []}
+    tilepos_yx = nbp_basic.tilepos_yx
+    use_tiles = nbp_basic.use_tiles
+    # Look up the neighbours of each tile from its yx position, rather than searching all tile positions for each tile.
+    tilepos_to_tile = {tuple(tilepos_yx[t]): t for t in range(tilepos_yx.shape[0])}
+    use_tiles_set = set(use_tiles)
+    # align each tile to its north neighbour and its east neighbour
+    tile_pairs = {'north': [], 'east': []}
+    for t in use_tiles:
+        tile_y, tile_x = tilepos_yx[t]
+        for j, t_neighb in zip(directions, [tilepos_to_tile.get((tile_y + 1, tile_x)),
+                                            tilepos_to_tile.get((tile_y, tile_x + 1))]):
+            if t_neighb in use_tiles_set:
+                tile_pairs[j].append((t, t_neighb))
+    # Spots of each tile are used for the shift to its north and east neighbours and from its south and west
+    # neighbours, so only get them once. They are stored as contiguous floats, as the KDTree queries in compute_shift
+    # work in float64, so they are only converted once here rather than for every shift searched.
+    tile_spot_yxz = {t: np.ascontiguousarray(spot_yxz(local_yxz, t, r, c, spot_no), dtype=float)
+                     for t in use_tiles}
     # to convert z coordinate units to xy pixels when calculating distance to nearest neighbours
     z_scale = nbp_basic.pixel_size_z / nbp_basic.pixel_size_xy
-    with tqdm(total=2 * len(nbp_basic.use_tiles)) as pbar:
+    if config['n_jobs'] is None:
+        n_jobs = max(1, os.cpu_count() // 2)
+    else:
+        n_jobs = config['n_jobs']
+
+    def compute_pair_shift(t: int, t_neighb: int, j: str) -> Tuple[np.ndarray, float, float]:
+        return compute_shift(tile_spot_yxz[t], tile_spot_yxz[t_neighb], config['shift_score_thresh'],
+                             config['shift_score_thresh_multiplier'], config['shift_score_thresh_min_dist'],
+                             config['shift_score_thresh_max_dist'], config['neighb_dist_thresh'], shifts[j]['y'],
+                             shifts[j]['x'], shifts[j]['z'], config['shift_widen'], config['shift_max_range'],
+                             z_scale, config['nz_collapse'], config['shift_step'][2])[:3]
+
+    with tqdm(total=len(tile_pairs['north']) + len(tile_pairs['east'])) as pbar:
         pbar.set_description(f"Finding overlap between tiles in round {r} (ref_round)")
-        for t in nbp_basic.use_tiles:
-            # align to north neighbour followed by east neighbour
-            t_neighb['north'] = np.where(np.sum(nbp_basic.tilepos_yx == nbp_basic.tilepos_yx[t, :] + [1, 0],
-                                                axis=1) == 2)[0]
-            t_neighb['east'] = np.where(np.sum(nbp_basic.tilepos_yx == nbp_basic.tilepos_yx[t, :] + [0, 1],
-                                               axis=1) == 2)[0]
-            for j in directions:
-                pbar.set_postfix({'tile': t, 'direction': j})
-                if t_neighb[j].size > 0 and t_neighb[j] in nbp_basic.use_tiles:
-                    shift, score, score_thresh = compute_shift(spot_yxz(local_yxz, t, r, c, spot_no),
-                                                               spot_yxz(local_yxz, t_neighb[j][0], r, c, spot_no),
-                                                               config['shift_score_thresh'],
-                                                               config['shift_score_thresh_multiplier'],
-                                                               config['shift_score_thresh_min_dist'],
-                                                               config['shift_score_thresh_max_dist'],
-                                                               config['neighb_dist_thresh'], shifts[j]['y'],
-                                                               shifts[j]['x'], shifts[j]['z'],
-                                                               config['shift_widen'], config['shift_max_range'],
-                                                               z_scale, config['nz_collapse'],
-                                                               config['shift_step'][2])[:3]
-                    shift_info[j]['pairs'] = np.append(shift_info[j]['pairs'],
-                                                       np.array([t, t_neighb[j][0]]).reshape(1, 2), axis=0)
-                    shift_info[j]['shifts'] = np.append(shift_info[j]['shifts'], np.array(shift).reshape(1, 3), axis=0)
-                    shift_info[j]['score'] = np.append(shift_info[j]['score'], np.array(score).reshape(1, 1), axis=0)
-                    shift_info[j]['score_thresh'] = np.append(shift_info[j]['score_thresh'],
-                                                              np.array(score_thresh).reshape(1, 1), axis=0)
-                    good_shifts = (shift_info[j]['score'] > shift_info[j]['score_thresh']).flatten()
-                    if np.sum(good_shifts) >= 3:
-                        # once found shifts, refine shifts to be searched around these
-                        for i in range(len(coords)):
-                            shifts[j][coords[i]] = update_shifts(shifts[j][coords[i]],
-                                                                 shift_info[j]['shifts'][good_shifts, i])
+        # Until 3 good shifts are found in a direction, each shift found is used to refine the shifts searched for the
+        # next tile pair, so these are found one at a time. Once the search is refined, the remaining tile pairs are
+        # independent, so those of both directions are found together in parallel threads as the KDTree queries do
+        # not hold the GIL. Shifts that are not good enough are found again about all good shifts below.
+        pair_shifts = {j: [] for j in directions}
+        parallel_pairs = []
+        for j in directions:
+            for t, t_neighb in tile_pairs[j]:
+                if len(good_shift_list[j]) >= 3:
+                    break
+                pbar.set_postfix_str(f'tile={t}, direction={j}', refresh=False)
+                shift, score, score_thresh = compute_pair_shift(t, t_neighb, j)
+                pair_shifts[j].append((shift, score, score_thresh))
+                if score > score_thresh:
+                    good_shift_list[j].append(shift)
+                if len(good_shift_list[j]) >= 3:
+                    # once found shifts, refine shifts to be searched around these.
+                    # This is only done once per direction, as the serial loop stops here.
+                    good_shift_yxz = np.array(good_shift_list[j])
+                    for i in range(len(coords)):
+                        shifts[j][coords[i]] = update_shifts(shifts[j][coords[i]], good_shift_yxz[:, i])
                 pbar.update(1)
-    pbar.close()
+            parallel_pairs += [(t, t_neighb, j) for t, t_neighb in tile_pairs[j][len(pair_shifts[j]):]]
+        if len(parallel_pairs) > 0:
+            pbar.set_postfix_str('', refresh=False)
+            parallel_shifts = Parallel(n_jobs=n_jobs, prefer='threads')(
+                delayed(compute_pair_shift)(t, t_neighb, j) for t, t_neighb, j in parallel_pairs)
+            for (_, _, j), pair_shift in zip(parallel_pairs, parallel_shifts):
+                pair_shifts[j].append(pair_shift)
+            pbar.update(len(parallel_pairs))
+        for j in directions:
+            for (t, t_neighb), (shift, score, score_thresh) in zip(tile_pairs[j], pair_shifts[j]):
+                shift_info[j]['pairs'].append([t, t_neighb])
+                shift_info[j]['shifts'].append(shift)
+                shift_info[j]['score'].append(score)
+                shift_info[j]['score_thresh'].append(score_thresh)
+    for j in directions:
+        for var in ['pairs', 'shifts', 'score', 'score_thresh']:
+            shift_info[j][var] = np.vstack(shift_info[j][var])
 
     # amend shifts for which score fell below score_thresh
     for j in directions:
         good_shifts = (shift_info[j]['score'] > shift_info[j]['score_thresh']).flatten()
+        n_good_shifts = np.count_nonzero(good_shifts)
+        n_shifts = good_shifts.size
         for i in range(len(coords)):
             # change shift search to be near good shifts found
             # this will only do something if 3>sum(good_shifts)>0, otherwise will have been done in previous loop.
-            if np.sum(good_shifts) > 0:
+            if n_good_shifts > 0:
                 shifts[j][coords[i]] = update_shifts(shifts[j][coords[i]], shift_info[j]['shifts'][good_shifts, i])
-            elif good_shifts.size > 0:
+            elif n_shifts > 0:
                 shifts[j][coords[i]] = update_shifts(shifts[j][coords[i]], shift_info[j]['shifts'][:, i])
         # add outlier variable to shift_info to keep track of those shifts which are changed.
-        shift_info[j]['outlier_shifts'] = shift_info[j]['shifts'].copy()
-        shift_info[j]['outlier_score'] = shift_info[j]['score'].copy()
-        shift_info[j]['outlier_shifts'][good_shifts, :] = 0
-        shift_info[j]['outlier_score'][good_shifts, :] = 0
-        if (np.sum(good_shifts) < 2 and len(good_shifts) > 4) or (np.sum(good_shifts) == 0 and len(good_shifts) > 0):
-            warnings.warn(f"{len(good_shifts) - np.sum(good_shifts)}/{len(good_shifts)}"
-                          f" of shifts fell below score threshold")
-        for i in np.where(good_shifts == False)[0]:
-            t = shift_info[j]['pairs'][i, 0]
-            t_neighb = shift_info[j]['pairs'][i, 1]
-            # re-find shifts that fell below threshold by only looking at shifts near to others found
-            # Don't allow any widening so shift found must be in this range.
-            # score_thresh given is 0, so it is not re-computed.
-            shift_info[j]['shifts'][i], shift_info[j]['score'][i] = \
-                compute_shift(spot_yxz(local_yxz, t, r, c, spot_no),
-                              spot_yxz(local_yxz, t_neighb, r, c, spot_no), 0, None, None,
-                              None, config['neighb_dist_thresh'], shifts[j]['y'], shifts[j]['x'], shifts[j]['z'],
-                              None, None, z_scale, config['nz_collapse'], config['shift_step'][2])[:2]
+        if n_good_shifts == n_shifts:
+            # no outliers so no need to select from shifts found.
+            shift_info[j]['outlier_shifts'] = np.zeros_like(shift_info[j]['shifts'])
+            shift_info[j]['outlier_score'] = np.zeros_like(shift_info[j]['score'])
+        else:
+            is_outlier = np.invert(good_shifts)[:, np.newaxis]
+            shift_info[j]['outlier_shifts'] = np.where(is_outlier, shift_info[j]['shifts'], 0)
+            shift_info[j]['outlier_score'] = np.where(is_outlier, shift_info[j]['score'], 0)
+        if (n_good_shifts < 2 and n_shifts > 4) or (n_good_shifts == 0 and n_shifts > 0):
+            warnings.warn(f"{n_shifts - n_good_shifts}/{n_shifts} of shifts fell below score threshold")
+        # re-find shifts that fell below threshold by only looking at shifts near to others found
+        # Don't allow any widening so shift found must be in this range.
+        # score_thresh given is 0, so it is not re-computed.
+        # The search range is fixed now, so the outlier tile pairs are independent and found in parallel threads.
+        outlier_ind = np.where(np.invert(good_shifts))[0]
+        outlier_shifts = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(compute_shift)(tile_spot_yxz[t], tile_spot_yxz[t_neighb], 0, None, None, None,
+                                   config['neighb_dist_thresh'], shifts[j]['y'], shifts[j]['x'], shifts[j]['z'],
+                                   None, None, z_scale, config['nz_collapse'], config['shift_step'][2])
+            for t, t_neighb in shift_info[j]['pairs'][outlier_ind])
+        for i, (t, t_neighb), outlier_shift in zip(outlier_ind, shift_info[j]['pairs'][outlier_ind], outlier_shifts):
+            shift_info[j]['shifts'][i], shift_info[j]['score'][i] = outlier_shift[:2]
             warnings.warn(f"\nShift from tile {t} to tile {t_neighb} changed from\n"
                           f"{shift_info[j]['outlier_shifts'][i]} to {shift_info[j]['shifts'][i]}.")
 
@@ -130,18 +176,19 @@ def stitch(config: dict, nbp_basic: NotebookPage, local_yxz: np.ndarray, spot_no
 
     # get tile origins in global coordinates.
     # global coordinates are built about central tile so find this first
-    tile_dist_to_centre = np.linalg.norm(nbp_basic.tilepos_yx[nbp_basic.use_tiles] -
-                                         np.mean(nbp_basic.tilepos_yx, axis=0), axis=1)
-    centre_tile = nbp_basic.use_tiles[tile_dist_to_centre.argmin()]
+    # squared distance has the same argmin so no need for the square root.
+    tile_diff_to_centre = tilepos_yx[use_tiles] - np.mean(tilepos_yx, axis=0)
+    tile_dist_to_centre_sq = np.einsum('ij,ij->i', tile_diff_to_centre, tile_diff_to_centre)
+    centre_tile = use_tiles[tile_dist_to_centre_sq.argmin()]
 
     # Currently this approach does not work when not all tiles used are connected, so check this first.
     min_hamming_dist = np.zeros(nbp_basic.n_tiles)
-    for t in nbp_basic.use_tiles:
+    for t in use_tiles:
         # find the min distance between this tile and all other tiles used
-        hamming_dist = np.sum(np.abs(nbp_basic.tilepos_yx[t] - nbp_basic.tilepos_yx[nbp_basic.use_tiles]), axis=1).astype(float)
+        hamming_dist = np.sum(np.abs(tilepos_yx[t] - tilepos_yx[use_tiles]), axis=1).astype(float)
         hamming_dist[hamming_dist == 0] = np.inf
         min_hamming_dist[t] = np.min(hamming_dist)
-    min_hamming_dist = min_hamming_dist[nbp_basic.use_tiles]
+    min_hamming_dist = min_hamming_dist[use_tiles]
     all_tiles_connected = np.all(min_hamming_dist == 1)
     no_tiles_connected = np.all(min_hamming_dist > 1)
 
@@ -155,10 +202,10 @@ def stitch(config: dict, nbp_basic: NotebookPage, local_yxz: np.ndarray, spot_no
                         "Setting all tile origins to non-overlapping values.")
         tile_origin = np.zeros((nbp_basic.n_tiles, 3))
         tile_origin[:, 2] = nbp_basic.nz / 2
-        tile_origin[:, :2] = nbp_basic.tilepos_yx * (1 - config['expected_overlap']) * nbp_basic.tile_sz
+        tile_origin[:, :2] = tilepos_yx * (1 - config['expected_overlap']) * nbp_basic.tile_sz
         tile_origin = tile_origin - tile_origin[centre_tile]
         # set unused tiles to nan
-        unused_tiles = np.setdiff1d(np.arange(nbp_basic.n_tiles), nbp_basic.use_tiles)
+        unused_tiles = np.setdiff1d(np.arange(nbp_basic.n_tiles), use_tiles)
         tile_origin[unused_tiles, :] = np.nan
 
     else:
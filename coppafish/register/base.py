@@ -1,4 +1,5 @@
 import nd2
+from typing import Optional
 import numpy as np
 from tqdm import tqdm
 from skimage.transform import hough_circle, hough_circle_peaks
@@ -11,6 +12,14 @@ from skimage.filters import sobel
 from coppafish.register.preprocessing import custom_shift, split_3d_image, replace_scale, populate_full, \
     merge_subvols, yxz_to_zyx_affine
 from skimage.registration import phase_cross_correlation
+try:
+    # Optional, warps images on the GPU if cupy is installed and a CUDA device is available
+    import cupy
+    from cupyx.scipy import ndimage as cupy_ndimage
+    if cupy.cuda.runtime.getDeviceCount() == 0:
+        cupy = None
+except Exception:
+    cupy = None
 
 
 def find_shift_array(subvol_base, subvol_target, position, r_threshold):
@@ -149,8 +158,8 @@ def ols_regression(shift, position):
     """
 
     # We are going to get rid of the shifts where any of the values are nan for regression
-    position = position[~np.isnan(shift[:, 0])]
-    shift = shift[~np.isnan(shift[:, 0])]
+    use = ~np.isnan(shift[:, 0])
+    position, shift = position[use], shift[use]
 
     new_position = position + shift
     position = np.vstack((position.T, np.ones(shift.shape[0]))).T
@@ -177,8 +186,8 @@ def huber_regression(shift, position, predict_shift=True):
         or 3
     """
     # We are going to get rid of the shifts where any of the values are nan for regression
-    position = position[~np.isnan(shift[:, 0])]
-    shift = shift[~np.isnan(shift[:, 0])]
+    use = ~np.isnan(shift[:, 0])
+    position, shift = position[use], shift[use]
     # Check if we have any shifts to predict
     if len(shift) == 0 and predict_shift:
         transform = np.zeros((3, 4))
@@ -474,7 +483,7 @@ def regularise_transforms(registration_data: dict, tile_origin: np.ndarray, resi
 
 # Function which runs a single iteration of the icp algorithm
 def get_transform(yxz_base: np.ndarray, yxz_target: np.ndarray, transform_old: np.ndarray, dist_thresh: float,
-                  robust=False):
+                  robust=False, yxz_base_pad: Optional[np.ndarray] = None, yxz_transform: Optional[np.ndarray] = None):
     """
     This finds the affine transform that transforms ```yxz_base``` such that the distances between the neighbours
     with ```yxz_target``` are minimised.
@@ -490,6 +499,10 @@ def get_transform(yxz_base: np.ndarray, yxz_target: np.ndarray, transform_old: n
             Typical: ```5```.
         robust: Boolean option to make regression robust. Selecting true will result in the algorithm maximising
             correntropy as opposed to minimising mse.
+        yxz_base_pad: ```float [n_base_spots x 4]```. ```yxz_base``` padded with a column of ones. If given, it is
+            used rather than padding ```yxz_base``` again.
+        yxz_transform: ```float [n_base_spots x 3]```. If given, the transformed base spots are written into this
+            array rather than a new one. Used by ```icp``` so iterations do not reallocate these arrays.
 
     Returns:
         - ```transform``` - ```float [4 x 3]```.
@@ -504,8 +517,9 @@ def get_transform(yxz_base: np.ndarray, yxz_target: np.ndarray, transform_old: n
     """
     # Step 1 computes matching, since yxz_target is a subset of yxz_base, we will loop through yxz_target and find
     # their nearest neighbours within yxz_transform, which is the initial transform applied to yxz_base
-    yxz_base_pad = np.pad(yxz_base, [(0, 0), (0, 1)], constant_values=1)
-    yxz_transform = yxz_base_pad @ transform_old
+    if yxz_base_pad is None:
+        yxz_base_pad = np.pad(yxz_base, [(0, 0), (0, 1)], constant_values=1)
+    yxz_transform = np.matmul(yxz_base_pad, transform_old, out=yxz_transform)
     yxz_transform_tree = KDTree(yxz_transform)
     # the next query works the following way. For each point in yxz_target, we look for the closest neighbour in the
     # anchor, which we have now applied the initial transform to. If this is below dist_thresh, we append its distance
@@ -554,6 +568,10 @@ def icp(yxz_base, yxz_target, dist_thresh, start_transform, n_iters, robust=Fals
         - converged - bool
             True if completed in less than n_iters and false o/w
     """
+    # Spot coordinates are stored as int16, convert them to float once here rather than in every iteration (KDTree
+    # query and the transform matmul would otherwise each make a float copy per iteration)
+    yxz_base = np.ascontiguousarray(yxz_base, dtype=np.float64)
+    yxz_target = np.ascontiguousarray(yxz_target, dtype=np.float64)
     # initialise transform
     transform = start_transform
     n_matches = np.zeros(n_iters)
@@ -562,13 +580,18 @@ def icp(yxz_base, yxz_target, dist_thresh, start_transform, n_iters, robust=Fals
 
     # Update transform. We want this to have max n_iters iterations. We will end sooner if all neighbours do not change
     # in 2 successive iterations. Define the variables for iteration 0 before we start the loop
-    transform, neighbour, n_matches[0], error[0] = get_transform(yxz_base, yxz_target, transform, dist_thresh, robust)
+    # The padded base spots and the transformed base spots buffer are the same shape every iteration, so are only
+    # allocated once
+    yxz_base_pad = np.pad(yxz_base, [(0, 0), (0, 1)], constant_values=1)
+    yxz_transform = np.zeros_like(yxz_base)
+    transform, neighbour, n_matches[0], error[0] = get_transform(yxz_base, yxz_target, transform, dist_thresh, robust,
+                                                                 yxz_base_pad, yxz_transform)
     i = 0
-    while i + 1 < n_iters and not all(prev_neighbour == neighbour):
+    while i + 1 < n_iters and not np.array_equal(prev_neighbour, neighbour):
         # update i and prev_neighbour
         prev_neighbour, i = neighbour, i + 1
         transform, neighbour, n_matches[i], error[i] = get_transform(yxz_base, yxz_target, transform, dist_thresh,
-                                                                     robust)
+                                                                     robust, yxz_base_pad, yxz_transform)
     # now fill in any variables that were not completed due to early exit
     n_matches[i:] = n_matches[i] * np.ones(n_iters - i)
     error[i:] = error[i] * np.ones(n_iters - i)
@@ -577,6 +600,23 @@ def icp(yxz_base, yxz_target, dist_thresh, start_transform, n_iters, robust=Fals
     return transform, n_matches, error, converged
 
 
+def affine_transform_image(image: np.ndarray, transform: np.ndarray) -> np.ndarray:
+    """
+    Applies `scipy.ndimage.affine_transform` to `image`. If cupy is installed and a CUDA device is available, the
+    transform is computed on the GPU with `cupyx.scipy.ndimage.affine_transform` which gives the same result but is
+    much faster for large images.
+    Args:
+        image: (n_z x n_y x n_x) ndarray of image to transform
+        transform: 3 x 4 zyx affine transform, as given to `scipy.ndimage.affine_transform`
+
+    Returns:
+        image_transformed: (n_z x n_y x n_x) ndarray of transformed image, same dtype as `image`
+    """
+    if cupy is None:
+        return affine_transform(image, transform)
+    return cupy.asnumpy(cupy_ndimage.affine_transform(cupy.asarray(image), cupy.asarray(transform)))
+
+
 def brightness_scale(preseq: np.ndarray, seq: np.ndarray, intensity_percentile: int = 99, sub_image_size: int = 500):
     """
     Function to find scale factor m and constant c such that m * preseq + c ~ seq. This is done by a regression on
@@ -1,5 +1,6 @@
 import os
 import pickle
+import shutil
 import itertools
 import numpy as np
 from tqdm import tqdm
@@ -52,9 +53,61 @@ def load_reg_data(nbp_file: NotebookPage, nbp_basic: NotebookPage, config: dict)
                              'channel_registration': channel_registration,
                              'initial_transform': np.zeros((n_tiles, n_rounds, n_channels, 4, 3)),
                              'blur': False}
+    # Add in the round registration of any tiles which were saved by save_reg_data_tile but have not been saved to
+    # registration_data.pkl yet
+    tile_dir = os.path.join(nbp_file.output_dir, 'reg_data_tiles')
+    if os.path.isdir(tile_dir):
+        for file_name in sorted(f for f in os.listdir(tile_dir) if f.endswith('.pkl')):
+            with open(os.path.join(tile_dir, file_name), 'rb') as f:
+                tile_data = pickle.load(f)
+            t = tile_data.pop('tile')
+            if t in registration_data['round_registration']['tiles_completed']:
+                continue
+            for key in tile_data.keys():
+                registration_data['round_registration'][key][t] = tile_data[key]
+            registration_data['round_registration']['tiles_completed'].append(t)
     return registration_data
 
 
+def save_reg_data_tile(nbp_file: NotebookPage, registration_data: dict, t: int):
+    """
+    Saves the round registration data of a single tile to its own file in the *reg_data_tiles* folder of the output
+    directory. This is much quicker than saving all of `registration_data` after every tile.
+    These files are merged back into `registration_data` by `load_reg_data`.
+    Args:
+        nbp_file: File Names notebook page
+        registration_data: dictionary of registration data, round registration of tile `t` must be completed
+        t: tile to save
+    """
+    tile_dir = os.path.join(nbp_file.output_dir, 'reg_data_tiles')
+    if not os.path.isdir(tile_dir):
+        os.makedirs(tile_dir)
+    tile_data = {key: value[t] for key, value in registration_data['round_registration'].items()
+                 if key != 'tiles_completed'}
+    tile_data['tile'] = t
+    # Write to a temporary file first so a half written file is never loaded
+    file_path = os.path.join(tile_dir, 't' + str(t) + '.pkl')
+    with open(file_path + '.tmp', 'wb') as f:
+        pickle.dump(tile_data, f, protocol=5)
+    os.replace(file_path + '.tmp', file_path)
+
+
+def save_reg_data(nbp_file: NotebookPage, registration_data: dict):
+    """
+    Saves all of `registration_data` to *registration_data.pkl* in the output directory. Any single tile files saved
+    with `save_reg_data_tile` are then deleted as they are included in this file.
+    Args:
+        nbp_file: File Names notebook page
+        registration_data: dictionary of registration data
+    """
+    # Protocol 5 writes the numpy array buffers straight to the file without first copying them into the pickle stream
+    with open(os.path.join(nbp_file.output_dir, 'registration_data.pkl'), 'wb') as f:
+        pickle.dump(registration_data, f, protocol=5)
+    tile_dir = os.path.join(nbp_file.output_dir, 'reg_data_tiles')
+    if os.path.isdir(tile_dir):
+        shutil.rmtree(tile_dir)
+
+
 def replace_scale(transform: np.ndarray, scale: np.ndarray):
     """
     Replace the diagonal of transform with new scales
@@ -126,6 +179,22 @@ def n_matches_to_frac_matches(n_matches: np.ndarray, spot_no: np.ndarray):
     return frac_matches
 
 
+def voxel_downsample(spot_yxz: np.ndarray, voxel_size: float) -> np.ndarray:
+    """
+    Splits space into cubes of side `voxel_size` and keeps only the first spot in each cube. Used to cap the number of
+    spots given to ICP in dense regions.
+    Args:
+        spot_yxz: (n_spots x 3) ndarray of spot coordinates
+        voxel_size: side length of each cube, in the same units as `spot_yxz`
+
+    Returns:
+        spot_yxz_downsampled: (n_spots_kept x 3) ndarray of the kept spots, in the same order as in `spot_yxz`
+    """
+    voxel = np.floor_divide(spot_yxz, voxel_size).astype(np.int64)
+    _, keep = np.unique(voxel, axis=0, return_index=True)
+    return spot_yxz[np.sort(keep)]
+
+
 def split_3d_image(image, z_subvolumes, y_subvolumes, x_subvolumes, z_box, y_box, x_box):
     """
     Splits a 3D image into y_subvolumes * x_subvolumes * z_subvolumes subvolumes.
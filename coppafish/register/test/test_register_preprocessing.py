@@ -1,5 +1,6 @@
 from coppafish.register import base as reg_base
 from coppafish.register import preprocessing as reg_pre
+from coppafish.setup import NotebookPage
 from skimage import data
 
 import numpy as np
@@ -168,3 +169,30 @@ def test_merge_subvols():
     assert np.allclose(merged[:3, :4, :5], subvols[0])
     assert np.allclose(merged[10:, 10:, 10:], subvols[1])
 
+
+
+def test_save_reg_data_tile(tmp_path):
+    # Setup data
+    rng = np.random.RandomState(0)
+    nbp_file = NotebookPage('file_names', {'output_dir': str(tmp_path)})
+    round_registration = {'tiles_completed': [0], 'shift': rng.rand(3, 2, 4, 3), 'transform': rng.rand(3, 2, 3, 4)}
+    registration_data = {'round_registration': round_registration, 'blur': False}
+    reg_pre.save_reg_data(nbp_file, registration_data)
+    # Now complete tile 2 and only save that tile
+    registration_data['round_registration']['shift'][2] = rng.rand(2, 4, 3)
+    registration_data['round_registration']['tiles_completed'].append(2)
+    reg_pre.save_reg_data_tile(nbp_file, registration_data, 2)
+    loaded_data = reg_pre.load_reg_data(nbp_file, None, None)
+    assert loaded_data['round_registration']['tiles_completed'] == [0, 2]
+    assert np.allclose(loaded_data['round_registration']['shift'], registration_data['round_registration']['shift'])
+    # Saving everything again should remove the single tile files
+    reg_pre.save_reg_data(nbp_file, loaded_data)
+    assert not (tmp_path / 'reg_data_tiles').exists()
+
+
+def test_voxel_downsample():
+    spot_yxz = np.array([[0, 0, 0], [9, 9, 9], [1, 1, 1], [2, 0, 0], [4, 4, 4], [3, 2, 1]])
+    # Only spot 2 shares a cube of side 2 with an earlier spot so is removed, order is kept
+    assert np.array_equal(reg_pre.voxel_downsample(spot_yxz, 2), spot_yxz[[0, 1, 3, 4, 5]])
+    assert np.array_equal(reg_pre.voxel_downsample(spot_yxz, 5), spot_yxz[[0, 1]])
+    assert np.array_equal(reg_pre.voxel_downsample(spot_yxz, 1), spot_yxz)
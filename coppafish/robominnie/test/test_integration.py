@@ -1,12 +1,51 @@
 import os
+import copy
 import numpy as np
 from coppafish.robominnie import RoboMinnie
 import warnings
 import pytest
 
 
+@pytest.fixture
+def output_dir(request) -> str:
+    """
+    Output directory unique to each integration test, so the tests can be run in parallel with `pytest -n auto -m slow`.
+    """
+    output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), f'integration_dir_{request.node.name}')
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+    return output_dir
+
+
+def _base_robominnie_factory():
+    """
+    Gives a function that returns a copy of a RoboMinnie instance with gene codes and pink noise already generated.
+    These are deterministic and expensive, so are only generated once for each set of RoboMinnie arguments.
+
+    The templates are cached per pytest session. With `pytest -n auto` each xdist worker has its own session, so a
+    template is only reused by tests that happen to run on the same worker.
+    """
+    templates = {}
+
+    def _base_robominnie(**kwargs) -> RoboMinnie:
+        key = tuple(sorted(kwargs.items()))
+        if key not in templates:
+            robominnie = RoboMinnie(**kwargs)
+            robominnie.generate_gene_codes()
+            robominnie.generate_pink_noise()
+            templates[key] = robominnie
+        return copy.deepcopy(templates[key])
+
+    return _base_robominnie
+
+
+@pytest.fixture(scope='session')
+def base_robominnie():
+    return _base_robominnie_factory()
+
+
 @pytest.mark.slow
-def test_integration_001() -> None:
+def test_integration_001(output_dir: str, base_robominnie) -> None:
     """
     Summary of input data: random spots and random, white noise.
 
@@ -14,13 +53,7 @@ def test_integration_001() -> None:
 
     Compares ground truth spots to OMP spots and reference spots.
     """
-    output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'integration_dir')
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-
-    robominnie = RoboMinnie(include_presequence=False, include_dapi=False)
-    robominnie.generate_gene_codes()
-    robominnie.generate_pink_noise()
+    robominnie = base_robominnie(include_presequence=False, include_dapi=False)
     robominnie.add_spots(n_spots=15_000, bleed_matrix=np.diag(np.ones(7)), spot_size_pixels=np.array([1.5, 1.5, 1.5]))
     robominnie.save_raw_images(output_dir=output_dir, overwrite=True)
     robominnie.run_coppafish()
@@ -40,7 +73,7 @@ def test_integration_001() -> None:
 
 
 @pytest.mark.slow
-def test_integration_002() -> None:
+def test_integration_002(output_dir: str, base_robominnie) -> None:
     """
     Summary of input data: random spots and random, white noise.
 
@@ -48,13 +81,7 @@ def test_integration_002() -> None:
 
     Compares ground truth spots to OMP spots and reference spots.
     """
-    output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'integration_dir')
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-
-    robominnie = RoboMinnie()
-    robominnie.generate_gene_codes()
-    robominnie.generate_pink_noise()
+    robominnie = base_robominnie()
     # Add spots to DAPI image as larger spots
     robominnie.add_spots(n_spots=10_000, bleed_matrix=np.diag(np.ones(7)), spot_size_pixels=np.array([1.5, 1.5, 1.5]), 
                          spot_size_pixels_dapi=np.array([9, 9, 9]), include_dapi=True, spot_amplitude_dapi=0.05)
@@ -77,7 +104,7 @@ def test_integration_002() -> None:
 
 
 @pytest.mark.slow
-def test_integration_003() -> None:
+def test_integration_003(output_dir: str, base_robominnie) -> None:
     """
     Summary of input data: random spots and random, white noise.
 
@@ -85,13 +112,7 @@ def test_integration_003() -> None:
 
     Compares ground truth spots to OMP spots and reference spots.
     """
-    output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'integration_dir')
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-
-    robominnie = RoboMinnie(include_presequence=False, include_dapi=False, n_tiles_x=2)
-    robominnie.generate_gene_codes()
-    robominnie.generate_pink_noise()
+    robominnie = base_robominnie(include_presequence=False, include_dapi=False, n_tiles_x=2)
     # Add spots to DAPI image as larger spots
     robominnie.add_spots(n_spots=25_000, bleed_matrix=np.diag(np.ones(7)), 
                          spot_size_pixels=np.array([1.5, 1.5, 1.5]), include_dapi=True, 
@@ -120,17 +141,16 @@ def test_integration_003() -> None:
 
 
 @pytest.mark.slow
-def test_bg_subtraction():
-    output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'integration_dir')
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-    
+def test_bg_subtraction(output_dir: str, base_robominnie):
     rng = np.random.RandomState(0)
 
-    robominnie = RoboMinnie(include_presequence=True, include_dapi=True, 
-                            brightness_scale_factor=2 * (0.1 + rng.rand(1, 9, 8)))
-    robominnie.generate_gene_codes()
-    robominnie.generate_pink_noise()
+    # Same as the default RoboMinnie, so the template from test_integration_002 is reused. The brightness scale factor
+    # is only used when saving the raw images
+    robominnie = base_robominnie()
+    brightness_scale_factor = 2 * (0.1 + rng.rand(1, 9, 8))
+    # Set after construction, so check the shape that RoboMinnie.__init__ would have asserted
+    assert brightness_scale_factor.shape == (robominnie.n_tiles, robominnie.n_rounds + 2, robominnie.n_channels + 1)
+    robominnie.brightness_scale_factor = brightness_scale_factor
     robominnie.add_spots(n_spots=15_000, bleed_matrix=np.diag(np.ones(7)), spot_size_pixels=np.array([1.5, 1.5, 1.5]),
                          gene_efficiency=0.5 * (rng.rand(15, 8) + 1), background_offset=1e-7*rng.rand(15_000, 7))
     robominnie.save_raw_images(output_dir=output_dir, overwrite=True)
@@ -152,4 +172,7 @@ def test_bg_subtraction():
 
 
 if __name__ == '__main__':
-    test_bg_subtraction()
+    main_output_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'integration_dir_test_bg_subtraction')
+    if not os.path.isdir(main_output_dir):
+        os.mkdir(main_output_dir)
+    test_bg_subtraction(main_output_dir, _base_robominnie_factory())
@@ -119,7 +119,8 @@ _options = {
             'isolation_thresh': 'maybe_number',
             'auto_isolation_thresh_multiplier': 'number',
             'n_spots_warn_fraction': 'number',
-            'n_spots_error_fraction': 'number'
+            'n_spots_error_fraction': 'number',
+            'n_jobs': 'int'
         },
     'stitch':
         {
@@ -141,7 +142,8 @@ _options = {
             'n_shifts_error_fraction': 'number',
             'save_image_zero_thresh': 'int',
             'flip_y': 'bool',
-            'flip_x': 'bool'
+            'flip_x': 'bool',
+            'n_jobs': 'maybe_int'
         },
     'register':
         {
@@ -154,8 +156,10 @@ _options = {
             'bead_radii': 'maybe_list_number',
             'icp_min_spots': 'int',
             'icp_max_iter': 'int',
+            'icp_voxel_size': 'maybe_number',
             'round_registration_channel': 'maybe_int',
-            'sobel': 'bool'
+            'sobel': 'bool',
+            'n_jobs': 'int'
         },
     'call_spots':
         {
@@ -975,7 +975,7 @@ def merge_find_spots(nbp_find_spots_list, master_nbp_basic) -> NotebookPage:
 
     # Now populate all the parameters
     spot_yxz = np.zeros((0, 3), dtype=int)
-    isolated_spots = np.zeros(0)
+    isolated_spots = np.zeros(0, dtype=bool)
     spot_no = np.zeros_like((n_tiles, n_rounds + 1, n_channels), dtype=int)
     isolation_thresh = np.zeros(n_tiles)
     for i in range(len(use_tiles)):
@@ -124,6 +124,13 @@ def get_spot_colors(yxz_base: np.ndarray, t: int, transforms: np.ndarray, nbp_fi
     else:
         tile_sz = np.array([nbp_basic.tile_sz, nbp_basic.tile_sz, nbp_basic.nz], dtype=np.int16)
 
+    # Check every transform used is non-zero once, before reading any npy files, rather than in the reading loops
+    check_rounds = list(use_rounds) + ([nbp_basic.pre_seq_round] if use_bg else [])
+    zero_transform = np.argwhere(transforms[t][np.ix_(check_rounds, use_channels)][:, :, 0, 0] == 0)
+    if zero_transform.shape[0] > 0:
+        r, c = check_rounds[zero_transform[0, 0]], use_channels[zero_transform[0, 1]]
+        raise ValueError(f"Transform for tile {t}, round {r}, channel {c} is zero:\n{transforms[t, r, c]}")
+
     with tqdm(total=n_use_rounds * n_use_channels, disable=no_verbose) as pbar:
         pbar.set_description(f"Reading {n_spots} spot_colors found on tile {t} from npy files")
         for r in range(n_use_rounds):
@@ -133,10 +140,6 @@ def get_spot_colors(yxz_base: np.ndarray, t: int, transforms: np.ndarray, nbp_fi
             for c in range(n_use_channels):
                 transform_rc = transforms[t, use_rounds[r], use_channels[c]]
                 pbar.set_postfix({'round': use_rounds[r], 'channel': use_channels[c]})
-                if transform_rc[0, 0] == 0:
-                    raise ValueError(
-                        f"Transform for tile {t}, round {use_rounds[r]}, channel {use_channels[c]} is zero:"
-                        f"\n{transform_rc}")
                 yxz_transform, in_range = apply_transform(yxz_base, transform_rc, tile_sz)
                 yxz_transform = yxz_transform[in_range]
                 if yxz_transform.shape[0] > 0:
@@ -155,10 +158,6 @@ def get_spot_colors(yxz_base: np.ndarray, t: int, transforms: np.ndarray, nbp_fi
             for c in range(n_use_channels):
                 transform_rc = transforms[t, nbp_basic.pre_seq_round, use_channels[c]]
                 pbar.set_postfix({'round': use_rounds[r], 'channel': use_channels[c]})
-                if transform_rc[0, 0] == 0:
-                    raise ValueError(
-                        f"Transform for tile {t}, round {nbp_basic.pre_seq_round}, channel {use_channels[c]} is zero:"
-                        f"\n{transform_rc}")
                 yxz_transform, in_range = apply_transform(yxz_base, transform_rc, tile_sz)
                 yxz_transform = yxz_transform[in_range]
                 if yxz_transform.shape[0] > 0:
@@ -7,21 +7,58 @@ import warnings
 import numpy_indexed
 
 
-def shift_score(distances: np.ndarray, thresh: float) -> float:
+def shift_score(distances: np.ndarray, thresh: float, axis: Optional[int] = None) -> Union[float, np.ndarray]:
     """
     Computes a score to quantify how good a shift is based on the distances between the neighbours found.
     the value of this score is approximately the number of close neighbours found.
 
     Args:
-        distances: `float [n_neighbours]`.
+        distances: `float [n_neighbours]` or `float [n_shifts x n_neighbours]`.
             Distances between each pair of neighbours.
         thresh: Basically the distance in pixels below which neighbours are a good match.
             Typical = `2`.
+        axis: Axis of `distances` to sum over. If `None`, all distances are summed to give a single score.
 
     Returns:
         Score to quantify how good a shift is based on the distances between the neighbours found.
     """
-    return np.sum(np.exp(-distances ** 2 / (2 * thresh ** 2)))
+    return np.sum(np.exp(-distances ** 2 / (2 * thresh ** 2)), axis=axis)
+
+
+def get_shift_scores(yxz_base: np.ndarray, yxz_transform_tree: KDTree, neighb_dist_thresh: float,
+                     shifts: np.ndarray, max_query_points: int = 2 ** 20) -> np.ndarray:
+    """
+    Computes the score of every shift in `shifts` applied to `yxz_base`, querying the tree with all the spots of
+    many shifts at once rather than one shift at a time.
+
+    Args:
+        yxz_base: `float [n_spots_base x n_dim]`.
+            Coordinates of spots on base image.
+        yxz_transform_tree: KDTree built from coordinates of spots on transformed image
+            (`float [n_spots_transform x n_dim]`).
+        neighb_dist_thresh: Basically the distance below which neighbours are a good match.
+            Typical = `2`.
+        shifts: `float [n_shifts x n_dim]`.
+            Shifts to find the score of.
+        max_query_points: Maximum number of shifted spots to query the tree with in one go, to limit memory.
+
+    Returns:
+        `float [n_shifts]`.
+            Score of each shift.
+    """
+    n_shifts = shifts.shape[0]
+    n_spots = yxz_base.shape[0]
+    score = np.zeros(n_shifts)
+    if n_spots == 0:
+        return score
+    dist_upper_bound = 3 * neighb_dist_thresh  # beyond this, score < exp(-4.5) and quicker to use this.
+    batch_size = max(1, max_query_points // n_spots)
+    for i in range(0, n_shifts, batch_size):
+        batch_shifts = shifts[i:i + batch_size]
+        yxz_shifted = (yxz_base[np.newaxis] + batch_shifts[:, np.newaxis]).reshape(-1, yxz_base.shape[1])
+        distances = yxz_transform_tree.query(yxz_shifted, distance_upper_bound=dist_upper_bound)[0]
+        score[i:i + batch_size] = shift_score(distances.reshape(-1, n_spots), neighb_dist_thresh, axis=1)
+    return score
 
 
 def extend_array(array: np.ndarray, extend_scale: int, direction: str = 'both') -> np.ndarray:
@@ -166,12 +203,7 @@ def get_best_shift_3d(yxz_base: np.ndarray, yxz_transform_tree: KDTree, neighb_d
     all_shifts = np.array(np.meshgrid(y_shifts, x_shifts, z_shifts)).T.reshape(-1, 3)
     if ignore_shifts is not None:
         all_shifts = setdiff2d(all_shifts, ignore_shifts)
-    score = np.zeros(all_shifts.shape[0])
-    dist_upper_bound = 3 * neighb_dist_thresh  # beyond this, score < exp(-4.5) and quicker to use this.
-    for i in range(all_shifts.shape[0]):
-        yxz_shifted = yxz_base + all_shifts[i]
-        distances = yxz_transform_tree.query(yxz_shifted, distance_upper_bound=dist_upper_bound)[0]
-        score[i] = shift_score(distances, neighb_dist_thresh)
+    score = get_shift_scores(yxz_base, yxz_transform_tree, neighb_dist_thresh, all_shifts)
     best_shift_ind = score.argmax()
     return all_shifts[best_shift_ind], score[best_shift_ind], all_shifts, score
 
@@ -210,12 +242,8 @@ def get_best_shift_2d(yx_base_slices: List[np.ndarray], yx_transform_trees: List
         all_shifts = setdiff2d(all_shifts, ignore_shifts)
     score = np.zeros(all_shifts.shape[0])
     n_trees = len(yx_transform_trees)
-    dist_upper_bound = 3 * neighb_dist_thresh  # beyond this, score < exp(-4.5) and quicker to use this.
-    for i in range(all_shifts.shape[0]):
-        for j in range(n_trees):
-            yx_shifted = yx_base_slices[j] + all_shifts[i]
-            distances = yx_transform_trees[j].query(yx_shifted, distance_upper_bound=dist_upper_bound)[0]
-            score[i] += shift_score(distances, neighb_dist_thresh)
+    for j in range(n_trees):
+        score += get_shift_scores(yx_base_slices[j], yx_transform_trees[j], neighb_dist_thresh, all_shifts)
     best_shift_ind = score.argmax()
     return all_shifts[best_shift_ind], score[best_shift_ind], all_shifts, score
 
@@ -38,9 +38,10 @@ def get_shifts_to_search(config: dict, nbp_basic: NotebookPage, nbp_debug: Optio
         if nbp_debug is not None:
             nbp_debug.__setattr__(j + '_' + 'start_shift_search', np.zeros((3, 3), dtype=int))
         for i in range(len(coords)):
-            shifts[j][coords[i]] = np.arange(config['shift_' + j + '_min'][i],
-                                             config['shift_' + j + '_max'][i] +
-                                             config['shift_step'][i] / 2, config['shift_step'][i]).astype(int)
+            # integer stop so the max shift is included without a float rounding guard.
+            shifts[j][coords[i]] = np.arange(int(config['shift_' + j + '_min'][i]),
+                                             int(config['shift_' + j + '_max'][i]) + 1,
+                                             int(config['shift_step'][i]), dtype=int)
             if nbp_debug is not None:
                 nbp_debug.__getattribute__(j + '_' + 'start_shift_search')[i, :] = [config['shift_' + j + '_min'][i],
                                                                                     config['shift_' + j + '_max'][i],
@@ -74,7 +74,8 @@ def imfilter_coords(image: np.ndarray, kernel: np.ndarray, coords: np.ndarray, p
                     corr_or_conv: str = 'corr') -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
     """
     Copy of MATLAB `imfilter` function with `'output_size'` equal to `'same'`.
-    Only finds result of filtering at specific locations but still filters entire image.
+    Only finds result of filtering at specific locations. The entire image is only filtered if there are many
+    locations or `padding` is not a number.
 
     !!! note
         image and image2 need to be np.int8 and kernel needs to be int otherwise will get cython error.
@@ -104,5 +105,40 @@ def imfilter_coords(image: np.ndarray, kernel: np.ndarray, coords: np.ndarray, p
         `int [n_points]`.
             Result of filtering of `image` at each point in `coords`.
     """
+    if isinstance(padding, numbers.Number) and kernel.ndim == image.ndim and \
+            coords.shape[0] * np.count_nonzero(kernel) < image.size:
+        # Few points compared to the image size, so only sum the image values in the kernel neighbourhood of each
+        # point, rather than filtering the entire image. Kernel is made odd in the same way as imfilter.
+        if corr_or_conv == 'corr':
+            kernel = ensure_odd_kernel(kernel, 'start')
+        elif corr_or_conv == 'conv':
+            kernel = np.flip(ensure_odd_kernel(kernel, 'end'))
+        else:
+            raise ValueError(f"corr_or_conv should be either 'corr' or 'conv' but given value is {corr_or_conv}")
+        kernel_shifts = np.argwhere(kernel != 0) - (np.array(kernel.shape) - 1) // 2
+        kernel_values = kernel[kernel != 0]
+        # Index the flattened image with the flat index of each point plus the flat offset of each kernel element,
+        # rather than stacking the coordinates of every neighbour.
+        image_flat = np.ravel(image)
+        image_strides = np.cumprod((image.shape[1:] + (1,))[::-1])[::-1]
+        kernel_flat_offsets = (kernel_shifts @ image_strides).astype(np.intp)
+        coords_flat = np.ravel_multi_index(tuple(coords.T), image.shape).astype(np.intp)
+        # Points are done in chunks so the neighbourhood arrays are at most max_neighb_size elements
+        max_neighb_size = 2 ** 22
+        chunk_size = max(1, max_neighb_size // max(1, kernel_values.size))
+        result = np.zeros(coords.shape[0], dtype=int)
+        for i in range(0, coords.shape[0], chunk_size):
+            # Neighbourhood values outside the image are set to padding
+            in_image = np.ones((min(chunk_size, coords.shape[0] - i), kernel_values.size), dtype=bool)
+            for j in range(image.ndim):
+                neighb_coord_j = coords[i:i + chunk_size, j:j + 1] + kernel_shifts[:, j]
+                in_image &= neighb_coord_j >= 0
+                in_image &= neighb_coord_j < image.shape[j]
+            neighb_index = coords_flat[i:i + chunk_size, np.newaxis] + kernel_flat_offsets
+            neighb_index[~in_image] = 0
+            neighb_values = image_flat[neighb_index].astype(int)
+            neighb_values[~in_image] = padding
+            result[i:i + chunk_size] = neighb_values @ kernel_values
+        return result
     im_filt = imfilter(image.astype(int), kernel, padding, corr_or_conv, oa=False)
     return im_filt[tuple([coords[:, j] for j in range(im_filt.ndim)])]
@@ -0,0 +1,17 @@
+from coppafish.utils.morphology.filter import imfilter, imfilter_coords
+
+import numpy as np
+
+
+def test_imfilter_coords():
+    rng = np.random.RandomState(0)
+    image = rng.randint(-1, 2, (30, 25, 6)).astype(np.int8)
+    # Even kernel sizes test that the kernel is made odd in the same way as imfilter
+    kernel = rng.randint(0, 2, (4, 3, 2))
+    # Include coordinates at the edges so the padding is used
+    coords = np.vstack((rng.randint(0, [30, 25, 6], (20, 3)), [[0, 0, 0], [29, 24, 5]]))
+    for corr_or_conv in ['corr', 'conv']:
+        for padding in [0, 1]:
+            im_filt = imfilter(image.astype(int), kernel, padding, corr_or_conv, oa=False)
+            expected = im_filt[coords[:, 0], coords[:, 1], coords[:, 2]]
+            assert np.array_equal(imfilter_coords(image, kernel, coords, padding, corr_or_conv), expected)
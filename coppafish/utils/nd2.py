@@ -30,7 +30,9 @@ def load(file_path: str) -> np.ndarray:
     with nd2.ND2File(file_path) as images:
         images = images.to_dask()
     # images = nd2.imread(file_name, dask=True)  # get python crashing with this in get_image for some reason
-    images = np.moveaxis(images, 1, -1)  # put z index to end
+    # put z index to end. This is lazy for a dask array, it only transposes each chunk as it is read, and nd2 chunks
+    # are single frames, so no extra copy of the data is made.
+    images = np.moveaxis(images, 1, -1)
     return images
 
 
@@ -82,21 +84,28 @@ def get_metadata(file_path: str, config: dict) -> dict:
         raise errors.NoFileError(file_path)
 
     with nd2.ND2File(file_path) as images:
-        metadata = {'n_tiles': images.sizes['P'],
-                    'n_channels': images.sizes['C'],
-                    'tile_sz': images.sizes['X'],
-                    'pixel_size_xy': images.metadata.channels[0].volume.axesCalibration[0],
-                    'pixel_size_z': images.metadata.channels[0].volume.axesCalibration[2]}
+        # look up sizes and calibration once as each attribute access goes through the nd2 reader.
+        sizes = images.sizes
+        axes_calibration = images.metadata.channels[0].volume.axesCalibration
+        metadata = {'n_tiles': sizes['P'],
+                    'n_channels': sizes['C'],
+                    'tile_sz': sizes['X'],
+                    'pixel_size_xy': axes_calibration[0],
+                    'pixel_size_z': axes_calibration[2]}
         # Check if data is 3d
-        if 'Z' in images.sizes:
+        if 'Z' in sizes:
             # subtract 1 as we always ignore first z plane
-            nz = images.sizes['Z']
+            nz = sizes['Z']
             metadata['tile_centre'] = np.array([metadata['tile_sz'], metadata['tile_sz'], nz])/2
         else:
             metadata['tile_centre'] = np.array([metadata['tile_sz'], metadata['tile_sz']])/2
 
-        xy_pos = np.array([images.experiment[0].parameters.points[i].stagePositionUm[:2]
-                           for i in range(images.sizes['P'])])
+        # Fill a preallocated array from the list of stage points, which is only looked up once, rather than building
+        # a list of positions and converting it.
+        stage_points = images.experiment[0].parameters.points
+        xy_pos = np.empty((sizes['P'], 2))
+        for i in range(sizes['P']):
+            xy_pos[i] = stage_points[i].stagePositionUm[:2]
         xy_pos = (xy_pos - np.min(xy_pos, 0)) / metadata['pixel_size_xy']
         metadata['xy_pos'] = xy_pos
         metadata['tilepos_yx_nd2'], metadata['tilepos_yx'] = get_tilepos(xy_pos=xy_pos, tile_sz=metadata['tile_sz'],
@@ -305,7 +314,12 @@ def get_image(images: np.ndarray, fov: int, channel: int, use_z: Optional[List[i
             Image of the desired `fov` and `channel`.
     """
     if use_z is None:
-        use_z = np.arange(images.shape[-1])
+        return np.asarray(images[fov, channel])
+    use_z = np.asarray(use_z).flatten()
+    if use_z.size > 0 and (np.diff(use_z) == 1).all():
+        # z-planes are usually a contiguous range, which is indexed as a slice. Dask then only reads the chunks of
+        # these z-planes, without building a graph to take each z-plane in use_z.
+        return np.asarray(images[fov, channel, :, :, use_z[0]:use_z[-1] + 1])
     return np.asarray(images[fov, channel, :, :, use_z])
 
 
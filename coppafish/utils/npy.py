@@ -80,7 +80,7 @@ def save_tile(nbp_file: NotebookPage, nbp_basic: NotebookPage, image: np.ndarray
 
 def load_tile(nbp_file: NotebookPage, nbp_basic: NotebookPage, t: int, r: int, c: int,
               yxz: Optional[Union[List, Tuple, np.ndarray, jnp.ndarray]] = None,
-              apply_shift: bool = True, suffix: str = '') -> np.ndarray:
+              apply_shift: bool = True, suffix: str = '', out: Optional[np.ndarray] = None) -> np.ndarray:
     """
     Loads in image corresponding to desired tile, round and channel from the relavent npy file.
 
@@ -104,11 +104,16 @@ def load_tile(nbp_file: NotebookPage, nbp_basic: NotebookPage, t: int, r: int, c
             May want to disable `apply_shift` to save memory and/or make loading quicker as there will be
             no dtype conversion. If loading in DAPI, dtype always uint16 as is no shift.
         suffix: Suffix to add to file name to load from.
+        out: `[ny x nx x nz]`. Can only be given when loading in a whole 3D tile. If given, the image is written into
+            `out` and `out` is returned, so no new tile sized arrays are allocated. Its dtype should be `int32` if the
+            shift is applied, `uint16` otherwise. Can be a view e.g. `np.moveaxis(zyx_buffer, 0, 2)`.
 
     Returns:
         `int32 [ny x nx (x nz)]` or `int32 [n_pixels x (2 or 3)]`
             Loaded image.
     """
+    if out is not None and (yxz is not None or not nbp_basic.is_3d):
+        raise ValueError('out can only be given when loading in a whole 3D tile, i.e. yxz is None and the data is 3D.')
     file_path = nbp_file.tile[t][r][c]
     file_path = file_path[:file_path.index('.npy')] + suffix + '.npy'
     if yxz is not None:
@@ -150,7 +155,15 @@ def load_tile(nbp_file: NotebookPage, nbp_basic: NotebookPage, t: int, r: int, c
                              f'the value of the image at these coordinates or \n'
                              f'a list containing {2 + int(nbp_basic.is_3d)} arrays indicating the sub image to load.')
     else:
-        if nbp_basic.is_3d :
+        if nbp_basic.is_3d and out is not None:
+            # Read straight into out, applying the shift at the same time
+            image = np.moveaxis(np.load(file_path, mmap_mode='r'), 0, 2)
+            if apply_shift and not (r == nbp_basic.anchor_round and c == nbp_basic.dapi_channel):
+                np.subtract(image, nbp_basic.tile_pixel_value_shift, out=out, dtype=np.int32)
+            else:
+                np.copyto(out, image)
+            return out
+        elif nbp_basic.is_3d:
             # Don't use mmap when loading in whole image
             image = np.moveaxis(np.load(file_path), 0, 2)
         else:
@@ -0,0 +1,29 @@
+from coppafish.setup import NotebookPage
+from coppafish.utils.npy import load_tile
+
+import numpy as np
+import pytest
+
+
+def test_load_tile_out(tmp_path):
+    rng = np.random.RandomState(0)
+    # Tiles are saved in zyx
+    image = rng.randint(0, 2 ** 16, size=(4, 10, 12)).astype(np.uint16)
+    file_path = str(tmp_path / 't0r0c0.npy')
+    np.save(file_path, image)
+    nbp_file = NotebookPage('file_names', {'tile': [[[file_path]]]})
+    nbp_basic = NotebookPage('basic_info', {'is_3d': True, 'anchor_round': 1, 'dapi_channel': None,
+                                            'tile_pixel_value_shift': 15000})
+    expected = load_tile(nbp_file, nbp_basic, 0, 0, 0)
+    zyx_buffer = np.zeros((2,) + image.shape, dtype=np.int32)
+    output = load_tile(nbp_file, nbp_basic, 0, 0, 0, out=np.moveaxis(zyx_buffer[1], 0, 2))
+    assert np.shares_memory(output, zyx_buffer)
+    assert np.array_equal(output, expected)
+    assert np.array_equal(zyx_buffer[1], np.moveaxis(expected, 2, 0))
+    assert (zyx_buffer[0] == 0).all()
+    zyx_buffer = np.zeros(image.shape, dtype=np.uint16)
+    load_tile(nbp_file, nbp_basic, 0, 0, 0, apply_shift=False, out=np.moveaxis(zyx_buffer, 0, 2))
+    assert np.array_equal(zyx_buffer, image)
+    # out cannot be used when only loading part of the tile
+    with pytest.raises(ValueError):
+        load_tile(nbp_file, nbp_basic, 0, 0, 0, yxz=[None, None, np.arange(2)], out=np.moveaxis(zyx_buffer, 0, 2))